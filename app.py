@@ -1,10 +1,20 @@
 #!/usr/bin/env python -*- coding: utf-8 -*-
+import mimetypes
 import os
+import time
 
-from flask import Flask, request, send_file
-from utils import download_file, download_all_epgs, M3U_CACHE_FILE_PATH, \
-    M3U_FILE, filter_epg, EPG_ALL_CACHE_FILE_PATH, EPG_ALL_GZ_CACHE_FILE_PATH, M3U_GZ_CACHE_FILE_PATH, gzip_file, \
-    sizeof_fmt, CACHE_FOLDER, M3U_UPDATED_CACHE_FILE_PATH, M3U_UPDATED_GZ_CACHE_FILE_PATH
+from flask import Flask, Response, request, send_file, send_from_directory, jsonify, abort, g
+import metrics
+from profiling import get_profiles, PROFILE_SUMMARY_FILE
+from jobs import JobRunner
+from scheduler import RefreshScheduler
+from store import EpgStore
+from guide import ScheduleIndexHolder, programme_to_dict
+from bundle import BundleQuery, GzipBodyCache, generate_m3u, generate_epg, encode_chunks, gzip_chunks, cache_chunks
+from utils import download_m3u, download_all_epgs, get_download_timeouts, M3U_CACHE_FILE_PATH, filter_epg, \
+    EPG_ALL_CACHE_FILE_PATH, EPG_ALL_GZ_CACHE_FILE_PATH, M3U_GZ_CACHE_FILE_PATH, CACHE_FOLDER, \
+    M3U_UPDATED_CACHE_FILE_PATH, M3U_UPDATED_GZ_CACHE_FILE_PATH, EPG_PARSE_WORKERS, EPG_STORE_CACHE_FILE_PATH, \
+    EPG_PROFILE, PROFILES_FOLDER
 from logger import get_logger
 
 m3u_url = os.getenv('M3U_URL', "https://no-m3u-url-provided")
@@ -27,68 +37,253 @@ app = Flask(__name__)
 
 logger = get_logger('iptv-helper')
 
+job_runner = JobRunner(logger)
+
+epg_store = EpgStore(EPG_STORE_CACHE_FILE_PATH)
+logger.info('epg store: %s' % epg_store.get_meta())
+schedule_index = ScheduleIndexHolder(logger, epg_store)
+bundle_cache = GzipBodyCache()
+
+
+@app.before_request
+def start_request_timer():
+    g.start_time = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    """Counts request by route pattern, so query args and channel names don't make new series.
+    Time of streamed bodies is not included, it is spent after the response is returned"""
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.http_requests.inc(route, str(response.status_code))
+    if 'start_time' in g:
+        metrics.http_request_seconds.observe(time.perf_counter() - g.start_time, route)
+    return response
+
+
+def update_job(job):
+    download_m3u(logger, m3u_url, job.stages)
+    download_all_epgs(logger, tv_epg_urls, get_download_timeouts(tv_epg_urls), progress=job.stages)
+
+
+def filter_job(job, request_host, workers, profile):
+    filter_epg(logger, request_host, workers, job.stages, profile)
+    refresh_scheduler.set_filtered(request_host)
+
+
+def update_filter_job(job, request_host, workers, profile):
+    update_job(job)
+    filter_job(job, request_host, workers, profile)
+
+
+def submit_job(name, function, *args):
+    job, created = job_runner.submit(name, function, *args)
+    return jsonify(job.to_dict()), 202, {'Location': '/jobs/' + job.id}
+
+
+def get_profile_arg():
+    return request.args.get('profile', '1' if EPG_PROFILE else '0') == '1'
+
 
 @app.route('/update-filter', methods=['GET'])
 def update_filter():
     logger.info('/update-filter')
-    update()
-    filter_all_epg()
-    return 'Updated-Filtered', 200
+    return submit_job('update-filter', update_filter_job, request.host,
+                      request.args.get('workers', EPG_PARSE_WORKERS, type=int), get_profile_arg())
 
 
 @app.route('/update', methods=['GET'])
 def update():
     logger.info('/update')
-    m3u_filename = download_file(logger, m3u_url, M3U_FILE)
-
-    gzip_file(m3u_filename, M3U_GZ_CACHE_FILE_PATH)
-    file_size = os.path.getsize(M3U_GZ_CACHE_FILE_PATH)
-    logger.info("/update , m3u gz file: %s, size: %s (%s)" % (M3U_GZ_CACHE_FILE_PATH, file_size, sizeof_fmt(file_size)))
-
-    download_all_epgs(logger, tv_epg_urls)
-    return 'Updated', 200
+    return submit_job('update', update_job)
 
 
 @app.route('/filter', methods=['GET'])
 def filter_all_epg():
     logger.info('/filter')
-    filter_epg(logger, request.host)
-    return 'Filtered', 200
+    return submit_job('filter', filter_job, request.host, request.args.get('workers', EPG_PARSE_WORKERS, type=int),
+                      get_profile_arg())
+
+
+@app.route('/jobs', methods=['GET'])
+def jobs():
+    return jsonify([job.to_dict() for job in job_runner.get_jobs()])
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_runner.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
+
+
+@app.route('/channels', methods=['GET'])
+def channels():
+    logger.info('/channels')
+    return jsonify(epg_store.get_m3u_items())
+
+
+@app.route('/now-next', methods=['GET'])
+def now_next():
+    """On air and next programme of channels by epg id or m3u name, all channels when channel is not set"""
+    index = schedule_index.get()
+    now = request.args.get('time', int(time.time()), type=int)
+    result = {}
+    for channel in request.args.getlist('channel') or index.channels.keys():
+        channel_id, schedule = index.get_channel(channel)
+        if schedule is None:
+            result[channel] = None
+        else:
+            current, next_programme = schedule.get_now_next(now)
+            result[channel] = {'channel_id': channel_id, 'now': programme_to_dict(current),
+                               'next': programme_to_dict(next_programme)}
+    return jsonify(result)
+
+
+@app.route('/programmes', methods=['GET'])
+def programmes():
+    """Programmes of channel by epg id or m3u name between start and stop unix time, next 24 hours by default"""
+    channel = request.args.get('channel', '')
+    start = request.args.get('start', int(time.time()), type=int)
+    stop = request.args.get('stop', start + 24 * 60 * 60, type=int)
+    channel_id, schedule = schedule_index.get().get_channel(channel)
+    if schedule is None:
+        abort(404)
+    return jsonify({'channel_id': channel_id, 'start': start, 'stop': stop,
+                    'programmes': [programme_to_dict(programme) for programme in schedule.get_programmes(start, stop)]})
+
+
+@app.route('/schedule', methods=['GET'])
+def schedule():
+    return jsonify(refresh_scheduler.to_dict())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_text():
+    """Pipeline and serving metrics in prometheus text format"""
+    metrics.bundle_cache_bytes.set(bundle_cache.size)
+    metrics.bundle_cache_lookups.set(bundle_cache.hits, 'hit')
+    metrics.bundle_cache_lookups.set(bundle_cache.misses, 'miss')
+    return Response(metrics.generate_latest(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/profiles', methods=['GET'])
+def profiles():
+    return jsonify(get_profiles(PROFILES_FOLDER))
+
+
+@app.route('/profiles/<profile_id>', methods=['GET'])
+def profile_summary(profile_id):
+    """Summary of filter run profile: per section time, memory, top functions and allocations"""
+    return send_from_directory(PROFILES_FOLDER, profile_id + '/' + PROFILE_SUMMARY_FILE, mimetype='application/json')
+
+
+@app.route('/profiles/<profile_id>/<file_name>', methods=['GET'])
+def profile_file(profile_id, file_name):
+    """cProfile file of a section or filter.prof of the whole run, for pstats or snakeviz"""
+    if not file_name.endswith('.prof'):
+        abort(404)
+    return send_from_directory(PROFILES_FOLDER, profile_id + '/' + file_name, mimetype='application/octet-stream',
+                               as_attachment=True)
+
+
+def send_compressed_file(file_name, gz_file_name):
+    """Sends gz_file_name as is with Content-Encoding: gzip when client accepts gzip, file_name otherwise.
+
+    send_file() adds ETag, Content-Length and Range support, file body is sent with sendfile by production server.
+    """
+    mimetype = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+    if request.accept_encodings['gzip'] > 0 and os.path.exists(gz_file_name):
+        response = send_file(gz_file_name, mimetype=mimetype, download_name=os.path.basename(file_name), etag=True,
+                             conditional=True)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_file(file_name, mimetype=mimetype, etag=True, conditional=True)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def send_bundle(kind, query, gzip_only=False):
+    """Sends playlist or epg filtered by query, generated from epg store while it is sent.
+
+    Gzip bodies are kept in bundle_cache by query and snapshot, clients without gzip get plain body generated again.
+    """
+    mimetype = 'application/xml' if kind == 'epg' else 'audio/mpegurl'
+    accept_gzip = gzip_only or request.accept_encodings['gzip'] > 0
+    snapshot, connection = epg_store.open_snapshot()
+    if connection is None:
+        abort(404)
+    key = query.get_key(kind, snapshot, request.host)
+    entry = bundle_cache.get(key) if accept_gzip else None
+    logger.info('send_bundle(%s), %s, cached: %s, %s' % (kind, query, entry is not None, bundle_cache))
+    if entry is not None:
+        connection.close()
+        response = Response(entry[0], mimetype=mimetype)
+        response.set_etag(entry[1])
+        response = response.make_conditional(request, accept_ranges=True, complete_length=len(entry[0]))
+    else:
+        if kind == 'epg':
+            chunks = encode_chunks(generate_epg(connection, query, request.host), connection)
+        else:
+            chunks = encode_chunks(generate_m3u(connection, query), connection)
+        if accept_gzip:
+            chunks = cache_chunks(bundle_cache, key, gzip_chunks(chunks))
+        response = Response(chunks, mimetype=mimetype)
+    if accept_gzip and not gzip_only:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
 
 
 @app.route('/epg', methods=['GET'])
 def epg():
     logger.info('/epg')
-    return send_file(EPG_ALL_CACHE_FILE_PATH, etag=True)
+    query = BundleQuery(request.args)
+    if not query.is_empty():
+        return send_bundle('epg', query)
+    return send_compressed_file(EPG_ALL_CACHE_FILE_PATH, EPG_ALL_GZ_CACHE_FILE_PATH)
 
 
 @app.route('/epg.gz', methods=['GET'])
 def epg2_gz():
     logger.info('/epg.gz')
+    query = BundleQuery(request.args)
+    if not query.is_empty():
+        return send_bundle('epg', query, True)
     return send_file(EPG_ALL_GZ_CACHE_FILE_PATH, etag=True)
 
 
 @app.route('/ttv', methods=['GET'])
 def ttv():
     logger.info('/ttv')
-    return send_file(M3U_CACHE_FILE_PATH, etag=True)
+    return send_compressed_file(M3U_CACHE_FILE_PATH, M3U_GZ_CACHE_FILE_PATH)
 
 
 @app.route('/ttv2', methods=['GET'])
 def ttv2():
     logger.info('/ttv2')
-    return send_file(M3U_UPDATED_CACHE_FILE_PATH, etag=True)
+    query = BundleQuery(request.args)
+    if not query.is_empty():
+        return send_bundle('m3u', query)
+    return send_compressed_file(M3U_UPDATED_CACHE_FILE_PATH, M3U_UPDATED_GZ_CACHE_FILE_PATH)
 
 
 @app.route('/ttv2.m3u8', methods=['GET'])
 def ttv2_m3u8():
     logger.info('/ttv2.m3u8')
-    return send_file(M3U_UPDATED_CACHE_FILE_PATH, etag=True)
+    query = BundleQuery(request.args)
+    if not query.is_empty():
+        return send_bundle('m3u', query)
+    return send_compressed_file(M3U_UPDATED_CACHE_FILE_PATH, M3U_UPDATED_GZ_CACHE_FILE_PATH)
 
 
 @app.route('/ttv2.gz', methods=['GET'])
 def ttv2_gz():
     logger.info('/ttv2.gz')
+    query = BundleQuery(request.args)
+    if not query.is_empty():
+        return send_bundle('m3u', query, True)
     return send_file(M3U_UPDATED_GZ_CACHE_FILE_PATH, etag=True)
 
 
@@ -98,5 +293,9 @@ def xmltv_dtd():
     return send_file(CACHE_FOLDER + 'xmltv.dtd', etag=True)
 
 
+refresh_scheduler = RefreshScheduler(logger, job_runner, m3u_url, tv_epg_urls, epg_store.get_meta().get('request_host'))
+refresh_scheduler.start()
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=101)
@@ -0,0 +1,501 @@
+#!/usr/bin/env python -*- coding: utf-8 -*-
+import argparse
+import glob
+import gzip
+import http.server
+import logging
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+
+from logger import get_logger
+from model_items import M3uIndex, xml_escape, parse_extinf_attributes, date_format, parse_xmltv_date
+from utils import load_xmlt, parse_m3u, sizeof_fmt, gzip_file, GzipTeeFile, filter_epg, download_all_epgs, \
+    CACHE_FOLDER, M3U_FILE, ALIASES_FILE
+from store import EpgStore, EpgStoreWriter
+from guide import ScheduleIndexHolder
+from merge import merge_channels
+
+logger = get_logger('benchmark')
+
+
+def generate_m3u(file_name, channels):
+    with open(file_name, 'w', encoding='utf-8') as f:
+        f.write("#EXTM3U\n")
+        for index in range(channels):
+            f.write("#EXTINF:-1 tvg-name=\"channel {index}\" tvg-logo=\"http://logo/{index}.png\","
+                    "Channel {index} HD\n#EXTGRP:Group {group}\nhttp://stream/{index}\n".format(index=index, group=index % 10))
+
+
+def generate_epg(file_name, channels, programmes_per_channel, matched_channels=None, minutes=60, first_channel=0,
+                 id_prefix='ch', collisions=0, programmes_first=0):
+    """Writes synthetic xmltv with programmes of given minutes starting 2 days ago, gzipped when file_name ends with .gz.
+
+    Channels first_channel..first_channel + channels are named as m3u channels below matched_channels, collisions
+    more channels repeat names of the first ones with other ids, programmes of the first programmes_first channels
+    are written before all <channel> elements.
+    """
+    if matched_channels is None:
+        matched_channels = first_channel + channels
+    start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(days=2)
+    rnd = random.Random(channels)
+    channel_list = []
+    for index in range(first_channel, first_channel + channels):
+        name = 'Channel %d HD' % index if index < matched_channels else 'Other %d' % index
+        channel_list.append(('%s%d' % (id_prefix, index), index, name))
+    for index in range(first_channel, first_channel + min(collisions, channels)):
+        channel_list.append(('%sdup%d' % (id_prefix, index), index, channel_list[index - first_channel][2]))
+
+    def write_programmes(f, channel_id):
+        for hour in range(programmes_per_channel):
+            program_start = start + timedelta(minutes=minutes * hour)
+            program_stop = program_start + timedelta(minutes=minutes)
+            f.write("\t<programme start=\"{start}\" stop=\"{stop}\" channel=\"{channel_id}\">\n"
+                    "\t\t<title lang=\"en\">{title}</title>\n\t\t<desc lang=\"en\">{desc}</desc>\n"
+                    "\t\t<category lang=\"en\">Category {category}</category>\n\t</programme>\n".format(
+                        start=program_start.strftime('%Y%m%d%H%M%S +0000'), stop=program_stop.strftime('%Y%m%d%H%M%S +0000'),
+                        channel_id=channel_id, title=xml_escape('Show %d & more' % rnd.randint(0, 10000)),
+                        desc='Description ' * rnd.randint(5, 40), category=rnd.randint(0, 20)))
+
+    open_file = gzip.open if file_name.endswith('.gz') else open
+    with open_file(file_name, 'wt', encoding='utf-8') as f:
+        f.write("<?xml version='1.0' encoding='UTF-8'?>\n<tv>\n")
+        for channel_id, index, name in channel_list[:programmes_first]:
+            write_programmes(f, channel_id)
+        for channel_id, index, name in channel_list:
+            f.write("\t<channel id=\"{channel_id}\">\n\t\t<display-name lang=\"en\">{name}</display-name>\n"
+                    "\t\t<icon src=\"http://icon/{index}.png\"/>\n\t</channel>\n".format(channel_id=channel_id, index=index,
+                                                                                          name=name))
+        for channel_id, index, name in channel_list[programmes_first:]:
+            write_programmes(f, channel_id)
+        f.write("</tv>\n")
+
+
+def read_io_counters():
+    """Returns (bytes read, bytes written) by this process through read/write calls, zeros where /proc is absent"""
+    counters = {'rchar': 0, 'wchar': 0}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except (FileNotFoundError, PermissionError):
+        pass
+    return counters['rchar'], counters['wchar']
+
+
+def measure(name, function, *args):
+    read_start, written_start = read_io_counters()
+    start_time = time.time()
+    result = function(*args)
+    elapsed = time.time() - start_time
+    read_end, written_end = read_io_counters()
+    print("%-30s time: %8.3fs, read: %10s, written: %10s" % (
+        name, elapsed, sizeof_fmt(read_end - read_start), sizeof_fmt(written_end - written_start)))
+    return result
+
+
+def load_epg(m3u_file, epg_file, channel_map=None):
+    m3u_index = M3uIndex(parse_m3u(logger, m3u_file))
+    today = date.today()
+    if channel_map is None:
+        channel_map = {}
+    stats = {'programmes': 0}
+    load_xmlt(logger, today, today + timedelta(days=7), m3u_index, epg_file, channel_map, stats)
+    return len(channel_map), stats['programmes']
+
+
+def gunzip_and_load_epg(m3u_file, gz_file):
+    xml_file = gz_file.replace('.gz', '')
+    with gzip.open(gz_file, 'rb') as f_in:
+        with open(xml_file, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    return load_epg(m3u_file, xml_file)
+
+
+def benchmark_compressed(args):
+    """Compares parsing gzipped epg directly against gunzip to disk and parsing the xml"""
+    with tempfile.TemporaryDirectory() as folder:
+        m3u_file = os.path.join(folder, 'm3u.m3u')
+        gz_file = os.path.join(folder, 'epg-1.xml.gz')
+        generate_m3u(m3u_file, args.channels)
+        generate_epg(gz_file, args.channels, args.programmes)
+        print("epg gz size: %s" % sizeof_fmt(os.path.getsize(gz_file)))
+
+        result_xml = measure('gunzip to disk + parse xml', gunzip_and_load_epg, m3u_file, gz_file)
+        print("epg xml size: %s" % sizeof_fmt(os.path.getsize(gz_file.replace('.gz', ''))))
+        result_gz = measure('parse gz stream', load_epg, m3u_file, gz_file)
+        print("channels, programmes: %s, %s" % (result_xml, result_gz))
+
+
+def get_peak_rss():
+    # ru_maxrss is in KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def load_epg_peak_rss(m3u_file, epg_file):
+    logger.setLevel(logging.WARNING)
+    rss_before = get_peak_rss()
+    start_time = time.time()
+    result = load_epg(m3u_file, epg_file)
+    return result, time.time() - start_time, rss_before, get_peak_rss()
+
+
+def benchmark_memory(args):
+    """Measures peak RSS of load_xmlt() in a fresh process"""
+    with tempfile.TemporaryDirectory() as folder:
+        m3u_file = os.path.join(folder, 'm3u.m3u')
+        gz_file = os.path.join(folder, 'epg-1.xml.gz')
+        generate_m3u(m3u_file, args.channels)
+        generate_epg(gz_file, args.channels, args.programmes, minutes=args.minutes)
+        print("epg gz size: %s, programmes: %d" % (sizeof_fmt(os.path.getsize(gz_file)), args.channels * args.programmes))
+
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            result, elapsed, rss_before, rss_after = executor.submit(load_epg_peak_rss, m3u_file, gz_file).result()
+        print("channels, programmes: %s, time: %.3fs, peak rss before: %s, after: %s, growth: %s" % (
+            result, elapsed, sizeof_fmt(rss_before), sizeof_fmt(rss_after), sizeof_fmt(rss_after - rss_before)))
+
+
+def parse_extinf_with_searches(line):
+    """Attribute parsing as it was done before single pass tokenizer, one re.search per attribute"""
+    attributes = {}
+    for key in ('tvg-name', 'tvg-id', 'tvg-logo', 'group-title', 'tvg-rec'):
+        try:
+            attributes[key] = re.search(key + '="(.*?)"', line, re.IGNORECASE).group(1)
+        except AttributeError:
+            pass
+    return attributes
+
+
+def benchmark_m3u(args):
+    """Compares #EXTINF attributes parsing with re.search per attribute against single pass tokenizer"""
+    lines = []
+    for index in range(args.count):
+        lines.append("#EXTINF:-1 tvg-id=\"id{index}\" tvg-name=\"channel {index}\" tvg-logo=\"http://logo/{index}.png\" "
+                     "catchup=\"shift\" catchup-days=\"7\" group-title=\"Group {group}\",Channel {index} HD".format(index=index, group=index % 10))
+
+    baseline = measure('re.search per attribute', lambda: [parse_extinf_with_searches(line) for line in lines])
+    result = measure('parse_extinf_attributes', lambda: [parse_extinf_attributes(line, []) for line in lines])
+    same = all(attributes.items() <= tokens.items() for attributes, tokens in zip(baseline, result))
+    print("lines: %d, same attributes: %s" % (len(lines), same))
+
+
+def write_epg(f, channels):
+    dates = {'start.oldest': None, 'start.newest': None, 'stop.oldest': None, 'stop.newest': None}
+    for channel_item in channels:
+        f.write(channel_item.to_xml_string())
+    for channel_item in channels:
+        for programme_item in channel_item.programs:
+            f.write(programme_item.to_xml_string(dates))
+
+
+def write_and_gzip_epg(file_name, channels):
+    with open(file_name, 'w') as f:
+        write_epg(f, channels)
+    gzip_file(file_name, file_name + '.gz')
+
+
+def write_epg_with_tee(file_name, channels):
+    f = GzipTeeFile(file_name)
+    write_epg(f, channels)
+    f.close()
+
+
+def benchmark_write(args):
+    """Compares writing epg and gzipping it from disk afterwards against writing both in one pass"""
+    with tempfile.TemporaryDirectory() as folder:
+        m3u_file = os.path.join(folder, 'm3u.m3u')
+        gz_file = os.path.join(folder, 'epg-1.xml.gz')
+        generate_m3u(m3u_file, args.channels)
+        generate_epg(gz_file, args.channels, args.programmes)
+        channel_map = {}
+        print("channels, programmes: %s, %s" % load_epg(m3u_file, gz_file, channel_map))
+        channels = list(channel_map.values())
+
+        measure('write + gzip_file', write_and_gzip_epg, os.path.join(folder, 'epg-all.xml'), channels)
+        print("epg size: %s, gz size: %s" % (sizeof_fmt(os.path.getsize(os.path.join(folder, 'epg-all.xml'))),
+                                             sizeof_fmt(os.path.getsize(os.path.join(folder, 'epg-all.xml.gz')))))
+        measure('GzipTeeFile', write_epg_with_tee, os.path.join(folder, 'epg-tee.xml'), channels)
+        print("epg size: %s, gz size: %s" % (sizeof_fmt(os.path.getsize(os.path.join(folder, 'epg-tee.xml'))),
+                                             sizeof_fmt(os.path.getsize(os.path.join(folder, 'epg-tee.xml.gz')))))
+
+
+def benchmark_timestamps(args):
+    """Compares xmltv timestamp parsing with datetime.strptime against parse_xmltv_date"""
+    start = datetime(2024, 1, 25, tzinfo=timezone.utc)
+    offsets = [' +0000', ' +0100', ' +0300', ' -0500']
+    timestamps = []
+    for index in range(args.count):
+        timestamp = start + timedelta(minutes=5 * (index % 4000))
+        timestamps.append(timestamp.strftime('%Y%m%d%H%M%S') + offsets[index % len(offsets)])
+
+    baseline = measure('datetime.strptime', lambda: [datetime.strptime(value, date_format).date() for value in timestamps])
+    result = measure('parse_xmltv_date', lambda: [parse_xmltv_date(value) for value in timestamps])
+    print("timestamps: %d, same result: %s" % (len(timestamps), baseline == result))
+
+
+def write_store(store_file, channels):
+    store = EpgStoreWriter(logger, store_file)
+    dates = {'start.oldest': None, 'start.newest': None, 'stop.oldest': None, 'stop.newest': None}
+    for channel_item in channels:
+        store.add_channel(channel_item, channel_item.to_xml_string())
+        for programme_item in channel_item.programs:
+            store.add_programme(programme_item, programme_item.to_xml_string(dates))
+    store.close({})
+
+
+def query_now_next(index, channel_ids, times):
+    for now in times:
+        for channel_id in channel_ids:
+            index.channels[channel_id].get_now_next(now)
+
+
+def request_urls(client, urls):
+    for url in urls:
+        if client.get(url).status_code != 200:
+            raise Exception("request failed: %s" % url)
+
+
+def benchmark_guide(args):
+    """Measures now/next queries on schedule index and /now-next, /programmes requests through flask app"""
+    import app
+
+    with tempfile.TemporaryDirectory() as folder:
+        m3u_file = os.path.join(folder, 'm3u.m3u')
+        gz_file = os.path.join(folder, 'epg-1.xml.gz')
+        store_file = os.path.join(folder, 'epg.db')
+        generate_m3u(m3u_file, args.channels)
+        generate_epg(gz_file, args.channels, args.programmes)
+        channel_map = {}
+        print("channels, programmes: %s, %s" % load_epg(m3u_file, gz_file, channel_map))
+        measure('write store', write_store, store_file, list(channel_map.values()))
+
+        app.schedule_index = ScheduleIndexHolder(logger, EpgStore(store_file))
+        index = measure('load schedule index', app.schedule_index.get)
+        channel_ids = list(index.channels.keys())
+        now = int(time.time())
+        times = [now + minute * 60 for minute in range(0, args.queries // len(channel_ids) + 1)]
+        queries = len(times) * len(channel_ids)
+        start_time = time.time()
+        measure('now/next queries', query_now_next, index, channel_ids, times)
+        print("now/next queries: %d, %.1f us per query" % (queries, (time.time() - start_time) * 1000000 / queries))
+
+        client = app.app.test_client()
+        rnd = random.Random(args.requests)
+        urls = []
+        for request_index in range(args.requests):
+            channel_id = rnd.choice(channel_ids)
+            if request_index % 2 == 0:
+                urls.append('/now-next?channel=%s' % channel_id)
+            else:
+                urls.append('/programmes?channel=%s&start=%d&stop=%d' % (channel_id, now, now + 6 * 60 * 60))
+        start_time = time.time()
+        measure('http requests', request_urls, client, urls)
+        print("requests: %d, %.0f requests per second" % (len(urls), len(urls) / (time.time() - start_time)))
+
+
+def benchmark_merge(args):
+    """Measures merge_channels() on channels with every programme repeated, as when feeds repeat <programme>"""
+    with tempfile.TemporaryDirectory() as folder:
+        m3u_file = os.path.join(folder, 'm3u.m3u')
+        gz_file = os.path.join(folder, 'epg-1.xml.gz')
+        generate_m3u(m3u_file, args.channels)
+        generate_epg(gz_file, args.channels, args.programmes, minutes=args.minutes)
+        m3u_list = parse_m3u(logger, m3u_file)
+        m3u_index = M3uIndex(m3u_list)
+        today = date.today()
+        channel_map = {}
+        load_xmlt(logger, today, today + timedelta(days=7), m3u_index, gz_file, channel_map, {'programmes': 0})
+        for channel_item in channel_map.values():
+            programs = channel_item.programs * args.repeat
+            random.Random(channel_item.id).shuffle(programs)
+            channel_item.set_programs(programs)
+
+        stats = {'programmes': 0, 'duplicates': 0, 'overlaps': 0, 'cuts': 0, 'filled': 0}
+        start_time = time.time()
+        measure('merge_channels', merge_channels, logger, m3u_list, False, stats)
+        print("%s, %.0f programmes per second" % (stats, stats['programmes'] / (time.time() - start_time)))
+
+
+def generate_sources(folder, args):
+    """Writes m3u and args.sources epgs into folder/cache as downloaded files, sources overlap by half of their channels"""
+    cache_folder = os.path.join(folder, CACHE_FOLDER)
+    os.makedirs(cache_folder, exist_ok=True)
+    generate_m3u(os.path.join(cache_folder, M3U_FILE), args.channels)
+    files = []
+    for index in range(1, args.sources + 1):
+        file_name = os.path.join(cache_folder, 'epg-%d.xml%s' % (index, '' if args.plain else '.gz'))
+        generate_epg(file_name, args.source_channels, args.programmes, args.channels,
+                     first_channel=(index - 1) * args.source_channels // 2, id_prefix='s%d-' % index,
+                     collisions=args.collisions, programmes_first=args.programmes_first)
+        files.append(file_name)
+    return files
+
+
+def run_filter_epg(folder, workers):
+    """filter_epg() in folder with its stages progress, time and peak rss"""
+    os.chdir(folder)
+    logger.setLevel(logging.WARNING)
+    rss_before = get_peak_rss()
+    progress = []
+    start_time = time.time()
+    m3u_list = parse_m3u(logger, CACHE_FOLDER + M3U_FILE)
+    M3uIndex(m3u_list)
+    m3u_time = time.time() - start_time
+    start_time = time.time()
+    filter_epg(logger, 'localhost', workers, progress)
+    return progress, m3u_time, time.time() - start_time, rss_before, get_peak_rss()
+
+
+def print_filter_epg(name, result):
+    progress, m3u_time, elapsed, rss_before, rss_after = result
+    print("%s: filter_epg time: %.3fs, peak rss: %s, growth: %s" % (name, elapsed, sizeof_fmt(rss_after),
+                                                                     sizeof_fmt(rss_after - rss_before)))
+    print("  %-24s time: %8.3fs" % ('parse_m3u + M3uIndex', m3u_time))
+    for stats in progress:
+        if stats['stage'] == 'parse':
+            print("  %-24s time: %8.3fs, cached: %-5s, channels: %5d, programmes: %8d, state: %s" % (
+                'parse ' + os.path.basename(stats['file']), stats['time'], stats['cached'], stats['channels'],
+                stats['programmes'], stats['state']))
+        elif stats['stage'] == 'coverage':
+            print("  %-24s m3u: %d, matched: %d, with programmes: %d, programmes: %d" % (
+                stats['stage'], stats['m3u'], stats['matched'], stats['with_programmes'], stats['programmes']))
+        else:
+            print("  %-24s time: %8.3fs, channels: %5d, programmes: %8d" % (
+                stats['stage'], stats['time'], stats['channels'], stats['programmes']))
+
+
+def benchmark_pipeline(args):
+    """Runs filter_epg() on synthetic sources in a fresh process: cold, then with parsed cache, stage timings and peak rss"""
+    # Worker process runs in the temporary folder
+    os.environ['ALIASES_FILE'] = os.path.abspath(ALIASES_FILE)
+    with tempfile.TemporaryDirectory() as folder:
+        files = generate_sources(folder, args)
+        for file_name in files:
+            print("%s size: %s" % (os.path.basename(file_name), sizeof_fmt(os.path.getsize(file_name))))
+        for name in ('cold', 'parsed cache'):
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                print_filter_epg(name, executor.submit(run_filter_epg, folder, args.workers).result())
+
+
+class BenchmarkRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves files with keep-alive and latency before every response, as remote epg providers do"""
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(folder, latency):
+    handler = type('Handler', (BenchmarkRequestHandler,), {'latency': latency})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), lambda *handler_args: handler(*handler_args, directory=folder))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def benchmark_download(args):
+    """Runs download_all_epgs() against local http server with synthetic sources: full download, then conditional one"""
+    with tempfile.TemporaryDirectory() as folder:
+        files = generate_sources(os.path.join(folder, 'www'), args)
+        server = start_http_server(os.path.join(folder, 'www', CACHE_FOLDER), args.latency)
+        urls = ['http://127.0.0.1:%d/%s' % (server.server_address[1], os.path.basename(file_name)) for file_name in files]
+        os.makedirs(os.path.join(folder, CACHE_FOLDER))
+        os.chdir(folder)
+        try:
+            for name in ('full', 'conditional'):
+                stats_list = measure('download_all_epgs ' + name, download_all_epgs, logger, urls, None, args.workers,
+                                     args.per_host)
+                print("  statuses: %s, downloaded: %s, files: %s" % (
+                    sorted(set(stats['status'] for stats in stats_list)),
+                    sizeof_fmt(sum(stats['bytes'] for stats in stats_list)),
+                    sizeof_fmt(sum(os.path.getsize(file_name) for file_name in glob.glob(CACHE_FOLDER + 'epg-*.xml*')))))
+        finally:
+            server.shutdown()
+
+
+def add_sources_arguments(parser):
+    parser.add_argument('--channels', type=int, default=2000, help='m3u channels')
+    parser.add_argument('--sources', type=int, default=3)
+    parser.add_argument('--source-channels', type=int, default=1000)
+    parser.add_argument('--programmes', type=int, default=24 * 10, help='programmes per channel')
+    parser.add_argument('--collisions', type=int, default=50, help='channels repeating names of others in every source')
+    parser.add_argument('--programmes-first', type=int, default=0,
+                        help='channels with programmes before <channel> elements in every source')
+    parser.add_argument('--plain', action='store_true', help='plain xml instead of gzip')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='iptv-helper benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    compressed = subparsers.add_parser('compressed', help=benchmark_compressed.__doc__)
+    compressed.add_argument('--channels', type=int, default=500)
+    compressed.add_argument('--programmes', type=int, default=24 * 14)
+    compressed.set_defaults(function=benchmark_compressed)
+
+    memory = subparsers.add_parser('memory', help=benchmark_memory.__doc__)
+    memory.add_argument('--channels', type=int, default=440)
+    memory.add_argument('--programmes', type=int, default=3000)
+    memory.add_argument('--minutes', type=int, default=5)
+    memory.set_defaults(function=benchmark_memory)
+
+    m3u = subparsers.add_parser('m3u', help=benchmark_m3u.__doc__)
+    m3u.add_argument('--count', type=int, default=40000)
+    m3u.set_defaults(function=benchmark_m3u)
+
+    write = subparsers.add_parser('write', help=benchmark_write.__doc__)
+    write.add_argument('--channels', type=int, default=500)
+    write.add_argument('--programmes', type=int, default=24 * 14)
+    write.set_defaults(function=benchmark_write)
+
+    timestamps = subparsers.add_parser('timestamps', help=benchmark_timestamps.__doc__)
+    timestamps.add_argument('--count', type=int, default=1000000)
+    timestamps.set_defaults(function=benchmark_timestamps)
+
+    guide = subparsers.add_parser('guide', help=benchmark_guide.__doc__)
+    guide.add_argument('--channels', type=int, default=500)
+    guide.add_argument('--programmes', type=int, default=24 * 14)
+    guide.add_argument('--queries', type=int, default=1000000)
+    guide.add_argument('--requests', type=int, default=20000)
+    guide.set_defaults(function=benchmark_guide)
+
+    merge = subparsers.add_parser('merge', help=benchmark_merge.__doc__)
+    merge.add_argument('--channels', type=int, default=440)
+    merge.add_argument('--programmes', type=int, default=1500)
+    merge.add_argument('--minutes', type=int, default=5)
+    merge.add_argument('--repeat', type=int, default=2)
+    merge.set_defaults(function=benchmark_merge)
+
+    pipeline = subparsers.add_parser('pipeline', help=benchmark_pipeline.__doc__)
+    add_sources_arguments(pipeline)
+    pipeline.add_argument('--workers', type=int, default=1)
+    pipeline.set_defaults(function=benchmark_pipeline)
+
+    download = subparsers.add_parser('download', help=benchmark_download.__doc__)
+    add_sources_arguments(download)
+    download.add_argument('--latency', type=float, default=0.2, help='seconds before every response')
+    download.add_argument('--workers', type=int, default=4)
+    download.add_argument('--per-host', type=int, default=2)
+    download.set_defaults(function=benchmark_download)
+
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python -*- coding: utf-8 -*-
+import hashlib
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+from utils import get_epg_header, GZIP_COMPRESS_LEVEL
+
+# Megabytes of generated gzip bodies kept in memory
+BUNDLE_CACHE_SIZE = int(os.getenv('BUNDLE_CACHE_SIZE', '64')) * 1024 * 1024
+BUNDLE_CHUNK_SIZE = 64 * 1024
+HOUR = 60 * 60
+
+
+class BundleQuery:
+    """Playlist and epg filter by group-title, tvg-id and time window from request args.
+
+    group and id can be repeated, id also takes comma separated list. start and stop are unix time,
+    rounded to whole hours, so requests made during one hour share the cached body.
+    """
+    def __init__(self, args):
+        self.groups = sorted(set(args.getlist('group')))
+        ids = set()
+        for value in args.getlist('id'):
+            ids.update(item for item in value.split(',') if item != '')
+        self.ids = sorted(ids)
+        start = args.get('start', type=int)
+        stop = args.get('stop', type=int)
+        self.start = start - start % HOUR if start is not None else None
+        self.stop = stop + (HOUR - stop % HOUR) % HOUR if stop is not None else None
+
+    def is_empty(self):
+        return len(self.groups) == 0 and len(self.ids) == 0 and self.start is None and self.stop is None
+
+    def get_key(self, kind, snapshot, request_host):
+        return repr((kind, snapshot, request_host if kind == 'epg' else None, self.groups, self.ids, self.start, self.stop))
+
+    def is_selected(self, group_title, tvg_id, channel_id):
+        if len(self.groups) > 0 and group_title not in self.groups:
+            return False
+        return len(self.ids) == 0 or tvg_id in self.ids or channel_id in self.ids
+
+    def __str__(self):
+        return 'BundleQuery[groups:%s, ids:%s, start:%s, stop:%s]' % (self.groups, self.ids, self.start, self.stop)
+
+
+def generate_m3u(connection, query):
+    yield "#EXTM3U\n"
+    for group_title, tvg_id, channel_id, m3u in connection.execute(
+            'SELECT group_title, tvg_id, channel_id, m3u FROM m3u ORDER BY position'):
+        if query.is_selected(group_title, tvg_id, channel_id):
+            yield m3u
+
+
+def generate_epg(connection, query, request_host):
+    """Combined epg of selected m3u items, every channel once, programmes in the order they were written"""
+    channel_ids = []
+    selected_ids = set()
+    for group_title, tvg_id, channel_id in connection.execute(
+            'SELECT group_title, tvg_id, channel_id FROM m3u WHERE channel_id IS NOT NULL ORDER BY position'):
+        if channel_id not in selected_ids and query.is_selected(group_title, tvg_id, channel_id):
+            selected_ids.add(channel_id)
+            channel_ids.append(channel_id)
+
+    yield get_epg_header(request_host)
+    for channel_id in channel_ids:
+        for row in connection.execute('SELECT xml FROM channels WHERE id = ?', (channel_id,)):
+            yield row[0]
+    for channel_id in channel_ids:
+        for row in connection.execute('SELECT xml FROM programmes WHERE channel_id = ? AND (? IS NULL OR stop > ?) '
+                                      'AND (? IS NULL OR start < ?) ORDER BY rowid',
+                                      (channel_id, query.start, query.start, query.stop, query.stop)):
+            yield row[0]
+    yield "</tv>\n"
+
+
+def encode_chunks(strings, connection, chunk_size=BUNDLE_CHUNK_SIZE):
+    """Joins strings into utf-8 chunks of about chunk_size, closes connection when done or client went away"""
+    try:
+        parts = []
+        size = 0
+        for string in strings:
+            parts.append(string)
+            size += len(string)
+            if size >= chunk_size:
+                yield ''.join(parts).encode('utf-8')
+                parts = []
+                size = 0
+        yield ''.join(parts).encode('utf-8')
+    finally:
+        connection.close()
+
+
+def gzip_chunks(chunks, level=GZIP_COMPRESS_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if len(data) > 0:
+            yield data
+    yield compressor.flush()
+
+
+def cache_chunks(cache, key, chunks):
+    """Passes chunks through and puts the whole body into cache when all of them were sent.
+
+    Chunks are not kept any more once body gets larger than the cache, such body is only streamed.
+    """
+    parts = []
+    size = 0
+    for chunk in chunks:
+        if parts is not None:
+            size += len(chunk)
+            if size > cache.max_size:
+                parts = None
+            else:
+                parts.append(chunk)
+        yield chunk
+    if parts is not None:
+        cache.put(key, b''.join(parts))
+
+
+class GzipBodyCache:
+    """LRU of generated gzip bodies with etag, limited by total size of bodies"""
+    def __init__(self, max_size=BUNDLE_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.bodies = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns (body, etag) or None"""
+        with self.lock:
+            entry = self.bodies.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.bodies.move_to_end(key)
+            return entry
+
+    def put(self, key, body):
+        if len(body) > self.max_size:
+            return
+        etag = hashlib.sha1(body).hexdigest()
+        with self.lock:
+            if key in self.bodies:
+                self.size -= len(self.bodies.pop(key)[0])
+            self.bodies[key] = (body, etag)
+            self.size += len(body)
+            while self.size > self.max_size:
+                old_key, (old_body, old_etag) = self.bodies.popitem(last=False)
+                self.size -= len(old_body)
+
+    def __str__(self):
+        return 'GzipBodyCache[bodies:%d, size:%d, hits:%d, misses:%d]' % (len(self.bodies), self.size, self.hits, self.misses)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python -*- coding: utf-8 -*-
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
+
+
+class ChannelSchedule:
+    """Programmes of one channel sorted by start, max_stops[i] is the latest stop of programmes 0..i.
+
+    max_stops is not decreasing even when programmes overlap, so both bounds of interval query are bisect.
+    """
+    __slots__ = ('starts', 'max_stops', 'programmes')
+
+    def __init__(self):
+        self.starts = []
+        self.max_stops = []
+        self.programmes = []
+
+    def add(self, start, stop, title, desc, category):
+        self.starts.append(start)
+        self.max_stops.append(stop if len(self.max_stops) == 0 else max(stop, self.max_stops[-1]))
+        self.programmes.append((start, stop, title, desc, category))
+
+    def get_now_next(self, now):
+        """Returns (programme on air at now or None, next programme after it or None)"""
+        index = bisect_right(self.starts, now)
+        current = None
+        position = index - 1
+        while position >= 0 and self.max_stops[position] > now:
+            if self.programmes[position][1] > now:
+                current = self.programmes[position]
+                break
+            position -= 1
+        next_programme = self.programmes[index] if index < len(self.programmes) else None
+        return current, next_programme
+
+    def get_programmes(self, start, stop):
+        """Returns programmes overlapping [start, stop) sorted by start"""
+        low = bisect_right(self.max_stops, start)
+        high = bisect_left(self.starts, stop)
+        return [programme for programme in self.programmes[low:high] if programme[1] > start]
+
+
+class ScheduleIndex:
+    """Per channel interval index of programmes in the published epg store, channel ids and m3u names are keys"""
+    def __init__(self):
+        self.channels = {}
+        self.names = {}
+        self.file_name = None
+        self.created = None
+
+    def load(self, logger, epg_store, file_name):
+        start_time = time.time()
+        channel_id = None
+        schedule = None
+        for row in epg_store.get_all_programmes():
+            if row[0] != channel_id:
+                channel_id = row[0]
+                schedule = self.channels[channel_id] = ChannelSchedule()
+            schedule.add(row[1], row[2], row[3], row[4], row[5])
+        for m3u_item in epg_store.get_m3u_items():
+            if m3u_item['channel_id'] is not None and m3u_item['name'] is not None:
+                self.names[m3u_item['name'].casefold()] = m3u_item['channel_id']
+        self.file_name = file_name
+        self.created = time.time()
+        logger.info('ScheduleIndex.load(%s), channels: %d, names: %d, time: %ss' % (
+            file_name, len(self.channels), len(self.names), time.time() - start_time))
+
+    def get_channel(self, channel):
+        """Returns (channel_id, ChannelSchedule) by channel id or m3u channel name, (None, None) when not known"""
+        schedule = self.channels.get(channel)
+        if schedule is not None:
+            return channel, schedule
+        channel_id = self.names.get(channel.casefold())
+        if channel_id is not None and channel_id in self.channels:
+            return channel_id, self.channels[channel_id]
+        return None, None
+
+
+class ScheduleIndexHolder:
+    """Keeps ScheduleIndex of the current snapshot, rebuilt once after 'current' link moves"""
+    def __init__(self, logger, epg_store):
+        self.logger = logger
+        self.epg_store = epg_store
+        self.index = ScheduleIndex()
+        self.lock = threading.Lock()
+
+    def get(self):
+        file_name = os.path.realpath(self.epg_store.file_name)
+        if self.index.file_name != file_name:
+            with self.lock:
+                if self.index.file_name != file_name:
+                    index = ScheduleIndex()
+                    index.load(self.logger, self.epg_store, file_name)
+                    self.index = index
+        return self.index
+
+
+def programme_to_dict(programme):
+    if programme is None:
+        return None
+    return {'start': programme[0], 'stop': programme[1], 'title': programme[2], 'desc': programme[3],
+            'category': programme[4]}
@@ -0,0 +1,12 @@
+#!/usr/bin/env python -*- coding: utf-8 -*-
+import os
+
+bind = '0.0.0.0:101'
+# Jobs and refresh scheduler state live in the app process, so there is one worker process
+# serving requests with threads, file bodies are sent with sendfile and do not hold the GIL
+workers = 1
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', '16'))
+sendfile = True
+keepalive = 5
+accesslog = '-'
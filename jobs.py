@@ -0,0 +1,103 @@
+#!/usr/bin/env python -*- coding: utf-8 -*-
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Finished jobs kept for /jobs/<id>
+JOBS_KEEP = int(os.getenv('JOBS_KEEP', '20'))
+
+
+class Job:
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = 'queued'
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        # Stage stats dicts, appended and updated by the job function
+        self.stages = []
+
+    def is_active(self):
+        return self.status in ('queued', 'running')
+
+    def to_dict(self):
+        stages = [dict(stage) for stage in list(self.stages)]
+        done = 0
+        for stage in stages:
+            if stage.get('state') in ('done', 'failed'):
+                done += 1
+        return {'id': self.id, 'name': self.name, 'status': self.status, 'error': self.error,
+                'created': self.created, 'started': self.started, 'finished': self.finished,
+                'time': (self.finished or time.time()) - (self.started or self.created),
+                'progress': {'done': done, 'total': len(stages)}, 'stages': stages}
+
+    def __str__(self):
+        return "Job(%s, %s, %s)" % (self.name, self.id, self.status)
+
+
+class JobRunner:
+    """Runs jobs one at a time in a background thread, so jobs never write the same cache files together.
+
+    Submitting a job with the name of a queued or running job returns that job instead of starting another one.
+    """
+    def __init__(self, logger, keep=JOBS_KEEP):
+        self.logger = logger
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.active = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='job')
+
+    def submit(self, name, function, *args):
+        """Returns (job, created), function is called as function(job, *args)"""
+        with self.lock:
+            job = self.active.get(name)
+            if job is not None:
+                self.logger.info("JobRunner.submit(%s), attached to: %s" % (name, job))
+                return job, False
+            job = Job(name)
+            self.jobs[job.id] = job
+            self.active[name] = job
+            self.remove_old_jobs()
+        self.logger.info("JobRunner.submit(%s), queued: %s" % (name, job))
+        self.executor.submit(self.run, job, function, args)
+        return job, True
+
+    def run(self, job, function, args):
+        self.logger.info("JobRunner.run(), started: %s" % job)
+        job.started = time.time()
+        job.status = 'running'
+        try:
+            function(job, *args)
+            job.status = 'done'
+        except Exception as e:
+            self.logger.error("JobRunner.run(), %s failed: %s" % (job, repr(e)))
+            traceback.print_exc()
+            job.error = repr(e)
+            job.status = 'failed'
+            for stage in job.stages:
+                if stage.get('state') == 'running':
+                    stage['state'] = 'failed'
+        job.finished = time.time()
+        with self.lock:
+            del self.active[job.name]
+        self.logger.info("JobRunner.run(), finished: %s, time: %ss" % (job, job.finished - job.started))
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def get_jobs(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def remove_old_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if not job.is_active()]
+        for job_id in finished[:max(len(finished) - self.keep, 0)]:
+            del self.jobs[job_id]
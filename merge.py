@@ -0,0 +1,103 @@
+#!/usr/bin/env python -*- coding: utf-8 -*-
+import heapq
+import time
+
+import metrics
+from store import get_timestamp
+
+
+def get_timed_programmes(programmes, timestamps, untimed):
+    """Returns sorted list of (start, stop, order, programme), programmes without valid times go to untimed"""
+    timed = []
+    for order, programme_item in enumerate(programmes):
+        start = timestamps.get(programme_item.start)
+        if start is None:
+            start = timestamps[programme_item.start] = get_timestamp(programme_item.start)
+        stop = timestamps.get(programme_item.stop)
+        if stop is None:
+            stop = timestamps[programme_item.stop] = get_timestamp(programme_item.stop)
+        if start is None or stop is None or stop < start:
+            untimed.append(programme_item)
+        else:
+            timed.append((start, stop, order, programme_item))
+    timed.sort(key=lambda item: (item[0], item[2]))
+    return timed
+
+
+def merge_programmes(programmes, timestamps, stats):
+    """Sweeps programmes sorted by start: drops exact duplicates and programmes starting together with kept one,
+    cuts stop of kept programme at start of the next one when they overlap, the cut one is dropped when it ends
+    in the past now.
+
+    Returns sorted list of (start, stop, programme) and list of programmes without valid times, kept as they are.
+    """
+    untimed = []
+    merged = []
+    for start, stop, order, programme_item in get_timed_programmes(programmes, timestamps, untimed):
+        if len(merged) > 0:
+            last_start, last_stop, last_item = merged[-1]
+            if start == last_start:
+                if stop == last_stop and programme_item.get_titles() == last_item.get_titles():
+                    stats['duplicates'] += 1
+                else:
+                    stats['overlaps'] += 1
+                continue
+            if start < last_stop:
+                cut_item = last_item.copy(stop=programme_item.start)
+                if cut_item.is_in_the_past:
+                    merged.pop()
+                else:
+                    merged[-1] = (last_start, start, cut_item)
+                stats['cuts'] += 1
+        merged.append((start, stop, programme_item))
+    return merged, untimed
+
+
+def fill_gaps(channel_id, merged, secondary_programmes, timestamps, stats):
+    """Returns merged with secondary programmes which fit between merged ones without overlapping them.
+
+    Both lists are sorted by start, so one pointer into merged finds the gap of every secondary programme.
+    """
+    fillers = []
+    position = 0
+    filler_stop = None
+    for start, stop, order, programme_item in get_timed_programmes(secondary_programmes, timestamps, []):
+        while position < len(merged) and merged[position][1] <= start:
+            position += 1
+        gap_start = merged[position - 1][1] if position > 0 else None
+        gap_stop = merged[position][0] if position < len(merged) else None
+        if (gap_start is None or start >= gap_start) and (gap_stop is None or stop <= gap_stop) and \
+                (filler_stop is None or start >= filler_stop):
+            fillers.append((start, stop, programme_item.copy(channel=channel_id)))
+            filler_stop = stop
+            stats['filled'] += 1
+    if len(fillers) == 0:
+        return merged
+    return list(heapq.merge(merged, fillers, key=lambda item: item[0]))
+
+
+def merge_channels(logger, m3u_list, fill_from_secondary, stats):
+    """Replaces programmes of every channel selected for m3u items with merged ones.
+
+    With fill_from_secondary gaps are filled with programmes of other channels matched to the same m3u item.
+    """
+    start_time = time.time()
+    timestamps = {}
+    merged_ids = set()
+    for m3u_item in m3u_list:
+        channel_item = m3u_item.get_max_programs()
+        if channel_item is None or channel_item.id in merged_ids:
+            continue
+        merged_ids.add(channel_item.id)
+        stats['programmes'] += len(channel_item.programs)
+        merged, untimed = merge_programmes(channel_item.programs, timestamps, stats)
+        if fill_from_secondary:
+            secondary_programmes = []
+            for other_channel_item in m3u_item.channels.values():
+                if other_channel_item is not channel_item:
+                    secondary_programmes.extend(other_channel_item.programs)
+            if len(secondary_programmes) > 0:
+                merged = fill_gaps(channel_item.id, merged, secondary_programmes, timestamps, stats)
+        channel_item.set_programs([item[2] for item in merged] + untimed)
+    logger.info('merge_channels(), channels: %d, %s, time: %ss' % (len(merged_ids), stats, time.time() - start_time))
+    metrics.stage_seconds.observe(time.time() - start_time, 'merge')
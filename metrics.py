@@ -0,0 +1,127 @@
+#!/usr/bin/env python -*- coding: utf-8 -*-
+import threading
+from bisect import bisect_left
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+registry = []
+
+
+def format_labels(label_names, label_values, extra=''):
+    labels = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+              for name, value in zip(label_names, label_values)]
+    if extra != '':
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if len(labels) > 0 else ''
+
+
+class Metric:
+    """Metric with values by label values tuple, in prometheus text format"""
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def get_samples(self):
+        with self.lock:
+            return [(self.name, label_values, '', value) for label_values, value in self.values.items()]
+
+    def to_text(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type)]
+        for name, label_values, extra, value in self.get_samples():
+            lines.append('%s%s %s' % (name, format_labels(self.label_names, label_values, extra), repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class CounterTotal(Metric):
+    """Counter of running total kept by its owner, set when metrics are read"""
+    type = 'counter'
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+    """Keeps count per bucket and sum, buckets are made cumulative only when metrics are read"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def get_samples(self):
+        samples = []
+        with self.lock:
+            values = [(label_values, list(entry[0]), entry[1]) for label_values, entry in self.values.items()]
+        for label_values, counts, total in values:
+            cumulative = 0
+            for bucket, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', label_values, 'le="%s"' % ('+Inf' if bucket == float('inf') else repr(float(bucket))),
+                                cumulative))
+            samples.append((self.name + '_sum', label_values, '', total))
+            samples.append((self.name + '_count', label_values, '', cumulative))
+        return samples
+
+
+def generate_latest():
+    return ''.join(metric.to_text() for metric in registry)
+
+
+# Pipeline
+download_seconds = Histogram('iptv_download_seconds', 'Download duration per source', ('source',))
+download_bytes = Counter('iptv_download_bytes_total', 'Bytes received per source', ('source',))
+download_responses = Counter('iptv_download_responses_total', 'Download responses per source and http status, 0 for errors',
+                             ('source', 'status'))
+parse_seconds = Histogram('iptv_parse_seconds', 'Parse duration per epg source, not observed for parsed cache hits', ('source',))
+parse_cached = Counter('iptv_parse_cached_total', 'Epg sources taken from parsed cache', ('source',))
+source_channels = Gauge('iptv_source_channels', 'Channels of epg source in the last filter: seen and matched with m3u',
+                        ('source', 'state'))
+source_programmes = Gauge('iptv_source_programmes', 'Programmes of epg source in the last filter: kept, out_of_window, '
+                                                    'unknown_channel, rescued (kept ones which came before their channel) '
+                                                    'and spilled (waited for their channel on disk)', ('source', 'state'))
+stage_seconds = Histogram('iptv_stage_seconds', 'Duration of pipeline stages: download, parse, merge, write and whole filter', ('stage',))
+m3u_channels = Gauge('iptv_m3u_channels', 'M3u channels in the last filter: all and with_programmes', ('state',))
+output_bytes = Gauge('iptv_output_bytes', 'Size of the last written output file', ('file',))
+output_compression_ratio = Gauge('iptv_output_compression_ratio', 'Plain to gzip size ratio of the last written output file',
+                                 ('file',))
+
+# Serving
+http_requests = Counter('iptv_http_requests_total', 'Http requests per route and status', ('route', 'status'))
+http_request_seconds = Histogram('iptv_http_request_seconds', 'Http request duration per route until response is returned',
+                                 ('route',))
+bundle_cache_bytes = Gauge('iptv_bundle_cache_bytes', 'Size of gzip bodies in filtered bundle cache')
+bundle_cache_lookups = CounterTotal('iptv_bundle_cache_lookups_total', 'Filtered bundle cache lookups by result: hit and miss',
+                                    ('result',))
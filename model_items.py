@@ -1,6 +1,8 @@
 #!/usr/bin/env python -*- coding: utf-8 -*-
+import heapq
 import re
-from datetime import datetime
+import sys
+from datetime import date, datetime, timedelta, timezone
 
 # import xml.etree.ElementTree as ET
 from lxml import etree as ET
@@ -8,6 +10,15 @@ from lxml import etree as ET
 # all_categories = []
 
 date_format = '%Y%m%d%H%M%S %z'
+# Time and offset part of xmltv timestamp after YYYYmmdd, seconds, minutes, hours and offset may be missing
+xmltv_time_pattern = re.compile(r'(\d\d)?(\d\d)?(\d\d)?\s*(Z|[+-]\d\d:?\d\d)?$')
+# All key="value" attributes of #EXTINF line in one pass
+extinf_attribute_pattern = re.compile(r'([\w-]+)="([^"]*)"')
+m3u_known_attributes = ('tvg-name', 'tvg-id', 'tvg-logo', 'group-title', 'tvg-rec')
+xmltv_date_cache = {}
+xmltv_time_cache = {}
+xml_escape_cache = {}
+XMLTV_CACHE_SIZE = 4096
 
 
 class M3uItem:
@@ -25,28 +36,15 @@ class M3uItem:
         self.tvg_rec = -1
         self.channels = {}
         self.max_programs = None
+        self.extra_attributes = []
 
         if m3u_fields is not None:
-            try:
-                self.tvg_name = re.search('tvg-name="(.*?)"', m3u_fields, re.IGNORECASE).group(1)
-            except AttributeError as e:
-                pass
-            try:
-                self.tvg_id = re.search('tvg-id="(.*?)"', m3u_fields, re.IGNORECASE).group(1)
-            except:
-                pass
-            try:
-                self.tvg_logo = re.search('tvg-logo="(.*?)"', m3u_fields, re.IGNORECASE).group(1)
-            except AttributeError as e:
-                pass
-            try:
-                self.group_title = re.search('group-title="(.*?)"', m3u_fields, re.IGNORECASE).group(1)
-            except AttributeError as e:
-                pass
-            try:
-                self.tvg_rec = re.search('tvg-rec="(.*?)"', m3u_fields, re.IGNORECASE).group(1)
-            except AttributeError as e:
-                pass
+            attributes = parse_extinf_attributes(m3u_fields, self.extra_attributes)
+            self.tvg_name = attributes.get('tvg-name')
+            self.tvg_id = attributes.get('tvg-id')
+            self.tvg_logo = attributes.get('tvg-logo')
+            self.group_title = attributes.get('group-title')
+            self.tvg_rec = attributes.get('tvg-rec', self.tvg_rec)
             try:
                 index = m3u_fields.find(',')
                 if index != -1:
@@ -69,37 +67,6 @@ class M3uItem:
             return ""
         return string
 
-    def process(self, channel_item):
-        if channel_item in self.channels:
-            return True
-
-        for display_name in channel_item.display_name_list:
-
-            if self.name_no_orig is not None and self.compare(display_name.text, self.name_no_orig):
-                self.channels[channel_item.id] = channel_item
-                insert_value_if_needed(channel_item.display_name_list, self.name)
-                return True
-
-            if self.name_no_dot_uk is not None and self.compare(display_name.text, self.name_no_dot_uk):
-                self.channels[channel_item.id] = channel_item
-                insert_value_if_needed(channel_item.display_name_list, self.name)
-                return True
-
-            if self.compare(display_name.text, self.name) or self.compare(display_name.text, self.tvg_name):
-                self.channels[channel_item.id] = channel_item
-                return True
-
-        return False
-
-    def compare(self, string1, string2):
-        if string1 is None or string2 is None:
-            return False
-
-        if string1 == string2 or string1.lower() == string2.lower():
-            return True
-
-        return False
-
     def get_logo(self):
         if self.tvg_logo is not None or self.tvg_logo != "":
             return self.tvg_logo
@@ -123,6 +90,9 @@ class M3uItem:
         if tvg_id is None and logo is None:
             result += " tvg-rec=\"0\""
 
+        for key, value in self.extra_attributes:
+            result += " {key}=\"{value}\"".format(key=key, value=value)
+
         result += ",{name}\n" \
                   "#EXTGRP:{tvg_group}\n" \
                   "{url}\n".format(name=self.name, tvg_group=self.group_title, url=self.url)
@@ -138,26 +108,28 @@ class M3uItem:
 
     def get_programs_count(self):
         count = 0
-        for key, value in self.channels.items():
-            # print("key: %s, value: %s" % (key, value))
+        for value in self.channels.values():
             count += value.get_programs_count()
         return count
 
-    def add_channels_and_programs(self, channels: list, programs: list):
+    def add_channels(self, channels: list):
         max_programs = self.get_max_programs()
 
         if max_programs is not None:
             channels.append(max_programs)
-            programs.extend(max_programs.programs)
 
     def get_max_programs(self):
+        """Returns channel with most programmes, first matched channel when none has more than others.
+
+        It is selected once on the first call, so it has to be called after all epg sources are loaded.
+        """
         if self.max_programs is None:
-            for key, value in self.channels.items():
-                len_programs = value.get_programs_count()
-                if self.max_programs is None:
-                    self.max_programs = value
-                elif len_programs > 0 and len_programs > self.max_programs.get_programs_count():
+            max_count = 0
+            for value in self.channels.values():
+                count = value.get_programs_count()
+                if self.max_programs is None or count > max_count:
                     self.max_programs = value
+                    max_count = count
         return self.max_programs
 
     def __str__(self):
@@ -167,13 +139,84 @@ class M3uItem:
                ', programs: ' + str(self.get_programs_count()) + ']'
 
 
+class M3uIndex:
+    """Case-folded lookup of m3u names (name, tvg_name, name_no_orig, name_no_dot_uk) to M3uItem.
+
+    Gives the same result as comparing every display name case-insensitively with those names of every entry
+    of the m3u list, but with one dictionary probe per display name instead of a scan over the whole list.
+    comparisons_saved counts comparisons of that scan, without its stop on the first match of an entry, less the probes.
+    """
+    def __init__(self, m3u_list):
+        self.m3u_list = m3u_list
+        self.names = {}
+        self.probes = 0
+        self.comparisons_saved = 0
+        # Names of all entries the scan compares every display name with
+        self.names_count = 0
+
+        for position, m3u_item in enumerate(m3u_list):
+            keys = {}
+            if m3u_item.name_no_orig is not None:
+                keys[m3u_item.name_no_orig.lower()] = True
+            if m3u_item.name_no_dot_uk is not None:
+                keys[m3u_item.name_no_dot_uk.lower()] = True
+            for name in (m3u_item.name, m3u_item.tvg_name):
+                if name is not None:
+                    keys.setdefault(name.lower(), False)
+            self.names_count += sum(1 for name in (m3u_item.name_no_orig, m3u_item.name_no_dot_uk, m3u_item.name,
+                                                   m3u_item.tvg_name) if name is not None)
+            for key, insert_name in keys.items():
+                self.names.setdefault(key, []).append((position, m3u_item, insert_name))
+
+    def lookup(self, text):
+        self.probes += 1
+        if text is None:
+            return ()
+        return self.names.get(text.lower(), ())
+
+    def match(self, channel_item):
+        """Adds channel_item to every matching M3uItem and returns their positions in the m3u list"""
+        display_name_list = channel_item.display_name_list
+        self.comparisons_saved += len(display_name_list) * (self.names_count - 1)
+
+        found = {}
+        for display_name in display_name_list:
+            for position, m3u_item, insert_name in self.lookup(display_name.text):
+                found.setdefault(position, (m3u_item, insert_name))
+
+        # Entries matched by name_no_orig/name_no_dot_uk add their name to display names,
+        # and only entries later in the m3u list can see that added name
+        queue = list(found)
+        heapq.heapify(queue)
+        while queue:
+            position = heapq.heappop(queue)
+            m3u_item, insert_name = found[position]
+            m3u_item.channels[channel_item.id] = channel_item
+            if insert_name and insert_value_if_needed(display_name_list, m3u_item.name):
+                for next_position, next_item, next_insert_name in self.lookup(m3u_item.name):
+                    if next_position > position and next_position not in found:
+                        found[next_position] = (next_item, next_insert_name)
+                        heapq.heappush(queue, next_position)
+
+        return sorted(found)
+
+    def __str__(self):
+        return 'M3uIndex[m3u_list:' + str(len(self.m3u_list)) + ', names:' + str(len(self.names)) + \
+               ', probes:' + str(self.probes) + ', comparisons_saved:' + str(self.comparisons_saved) + ']'
+
+
 class ChannelItem:
+    """Epg channel with its programmes, programs_count of not past programmes is kept up to date by add_program()
+    and set_programs(), programs list should not be changed in place"""
+    __slots__ = ('id', 'text', 'icon', 'display_name_list', 'programs', 'programs_count')
+
     def __init__(self, xmlt_fields):
         self.id = None
         self.text = None
         self.icon = None
         self.display_name_list = []
         self.programs = []
+        self.programs_count = 0
         self.id = xmlt_fields.attrib['id']
 
         for child in xmlt_fields:
@@ -198,18 +241,18 @@ class ChannelItem:
             ET.SubElement(item, 'icon').text = self.icon
 
     def to_xml_string(self):
-        result = "\t<channel id=\"{id}\">\n".format(id=self.id)
+        parts = ["\t<channel id=\"", self.id, "\">\n"]
         for display_name in self.display_name_list:
             if display_name.lang is None:
-                result += "\t\t<display-name>{name}</display-name>\n".format(name=xml_escape(display_name.text))
+                parts += ("\t\t<display-name>", xml_escape(display_name.text), "</display-name>\n")
             else:
-                result += "\t\t<display-name lang=\"{lang}\">{name}</display-name>\n".format(name=xml_escape(display_name.text), lang=xml_escape(display_name.lang))
+                parts += ("\t\t<display-name lang=\"", xml_escape(display_name.lang), "\">", xml_escape(display_name.text), "</display-name>\n")
 
         if self.icon is not None:
-            result += "\t\t<icon src=\"{url}\"/>\n".format(url=xml_escape(self.icon))
+            parts += ("\t\t<icon src=\"", xml_escape(self.icon), "\"/>\n")
 
-        result += "\t</channel>\n"
-        return result
+        parts.append("\t</channel>\n")
+        return ''.join(parts)
 
     def get_display_name(self):
         for display_name in self.display_name_list:
@@ -218,13 +261,15 @@ class ChannelItem:
 
     def add_program(self, program):
         self.programs.append(program)
+        if not program.is_in_the_past:
+            self.programs_count += 1
+
+    def set_programs(self, programs):
+        self.programs = programs
+        self.programs_count = sum(1 for program in programs if not program.is_in_the_past)
 
     def get_programs_count(self):
-        count = 0
-        for program in self.programs:
-            if not program.is_in_the_past:
-                count += 1
-        return count
+        return self.programs_count
 
     def __str__(self):
         return 'ChannelItem[id:' + str(self.id) + ', text:' + str(self.text) + \
@@ -232,55 +277,88 @@ class ChannelItem:
                ', programs:' + str(len(self.programs)) +']'
 
 
+class ExternalChannel:
+    """Stands for a channel matched in one of previous epg sources while an epg source is parsed on its own"""
+    __slots__ = ('id', 'programs')
+
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.programs = []
+
+    def add_program(self, program):
+        pass
+
+
 class NameItem:
+    __slots__ = ('lang', 'text')
+
     def __init__(self, text, lang=None, xmlt_fields=None):
         self.lang = lang
         self.text = text
         if xmlt_fields is not None and xmlt_fields.text is not None:
             self.text = xmlt_fields.text.strip()
             if 'lang' in xmlt_fields.attrib:
-                self.lang = xmlt_fields.attrib['lang']
+                # Only a few languages in all epgs, share one string per language
+                self.lang = sys.intern(xmlt_fields.attrib['lang'])
 
     def __str__(self):
         return 'NameItem[lang:' + self.lang + ', text:' + self.text + ']'
 
 
 class ProgrammeItem:
-    def __init__(self, logger, today, today_plus_one_week, xmlt_fields):
-        self.start = xmlt_fields.attrib['start']
-        self.stop = xmlt_fields.attrib['stop']
-        self.channel = xmlt_fields.attrib['channel']
-        self.is_in_the_past = False
-        self.is_in_the_future_one_week = False
-
-        try:
-            self.start_date = datetime.strptime(self.start, date_format).date()
-            self.is_in_the_future_one_week = self.start_date is not None and today_plus_one_week is not None and self.start_date > today_plus_one_week
-        except Exception as error:
-            logger.error("Error in ProgrammeItem, can't parse start: %s, error: %s" % (self.start, error))
-            self.start_date = None
-        try:
-            self.stop_date = datetime.strptime(self.stop, date_format).date()
-            self.is_in_the_past = self.stop_date is not None and today is not None and today > self.stop_date
-        except Exception as error:
-            logger.error("Error in ProgrammeItem, can't parse stop: %s, error: %s" % (self.stop, error))
-            self.stop_date = None
-
-        self.title_list = []
-        self.desc_list = []
-        self.category_list = []
+    __slots__ = ('start', 'stop', 'channel', 'start_date', 'stop_date', 'is_in_the_future_one_week', 'is_in_the_past',
+                 'title_list', 'desc_list', 'category_list')
+
+    def __init__(self, logger, today, today_plus_one_week, xmlt_fields, dates=None):
+        # Channel ids and time slots repeat in every programme
+        self.start = sys.intern(xmlt_fields.attrib['start'])
+        self.stop = sys.intern(xmlt_fields.attrib['stop'])
+        self.channel = sys.intern(xmlt_fields.attrib['channel'])
+
+        if dates is None:
+            dates = parse_programme_dates(logger, self.start, self.stop)
+        self.start_date, self.stop_date = dates
+        self.is_in_the_future_one_week = is_in_the_future(self.start_date, today_plus_one_week)
+        self.is_in_the_past = is_in_the_past(self.stop_date, today)
+
+        title_list = []
+        desc_list = []
+        category_list = []
         for child in xmlt_fields:
             if child.tag == 'title':
                 title = NameItem(None, None, child)
-                self.title_list.append(title)
+                title_list.append(title)
             else:
                 if child.tag == 'desc':
                     desc = NameItem(None, None, child)
-                    self.desc_list.append(desc)
+                    desc_list.append(desc)
                 else:
                     if child.tag == 'category':
                         category = NameItem(None, None, child)
-                        self.category_list.append(category)
+                        if category.text is not None:
+                            # Categories are a small set of repeated names
+                            category.text = sys.intern(category.text)
+                        category_list.append(category)
+        self.title_list = tuple(title_list)
+        self.desc_list = tuple(desc_list)
+        self.category_list = tuple(category_list)
+
+    def copy(self, channel=None, stop=None):
+        """Returns copy of programme moved to other channel or with other stop, texts are shared.
+        is_in_the_past of the new stop is checked against today"""
+        item = ProgrammeItem.__new__(ProgrammeItem)
+        for name in ProgrammeItem.__slots__:
+            setattr(item, name, getattr(self, name))
+        if channel is not None:
+            item.channel = channel
+        if stop is not None:
+            item.stop = stop
+            item.stop_date = parse_xmltv_date(stop)
+            item.is_in_the_past = is_in_the_past(item.stop_date, date.today())
+        return item
+
+    def get_titles(self):
+        return [title.text for title in self.title_list]
 
     def to_et_sub_element(self, root):
         item = ET.SubElement(root, 'programme', start=self.start, stop=self.stop,
@@ -309,31 +387,127 @@ class ProgrammeItem:
             dates['stop.newest'] = self.stop_date
             dates['stop.newest.str'] = self.stop
 
-        result = "\t<programme start=\"{start}\" stop=\"{stop}\" channel=\"{id}\">\n".format(start=self.start, stop=self.stop, id=self.channel)
+        parts = ["\t<programme start=\"", self.start, "\" stop=\"", self.stop, "\" channel=\"", self.channel, "\">\n"]
         for category in self.category_list:
-            # if category.text not in all_categories:
-            #     all_categories.append(category.text)
-            #     print("category: " + category.text)
             if category.lang is None:
-                result += "\t\t<category>{name}</category>\n".format(name=xml_escape(category.text))
+                parts += ("\t\t<category>", xml_escape_cached(category.text), "</category>\n")
             else:
-                result += "\t\t<category lang=\"{lang}\">{name}</category>\n".format(name=xml_escape(category.text), lang=category.lang)
+                parts += ("\t\t<category lang=\"", category.lang, "\">", xml_escape_cached(category.text), "</category>\n")
 
         for title in self.title_list:
             if title.text is not None:
                 if title.lang is None:
-                    result += "\t\t<title>{name}</title>\n".format(name=xml_escape(title.text))
+                    parts += ("\t\t<title>", xml_escape(title.text), "</title>\n")
                 else:
-                    result += "\t\t<title lang=\"{lang}\">{name}</title>\n".format(name=xml_escape(title.text), lang=title.lang)
+                    parts += ("\t\t<title lang=\"", title.lang, "\">", xml_escape(title.text), "</title>\n")
 
         for desc in self.desc_list:
             if desc.lang is None:
-                result += "\t\t<desc>{name}</desc>\n".format(name=xml_escape(desc.text))
+                parts += ("\t\t<desc>", xml_escape(desc.text), "</desc>\n")
             else:
-                result += "\t\t<desc lang=\"{lang}\">{name}</desc>\n".format(name=xml_escape(desc.text), lang=desc.lang)
-
-        result += "\t</programme>\n"
-        return result
+                parts += ("\t\t<desc lang=\"", desc.lang, "\">", xml_escape(desc.text), "</desc>\n")
+
+        parts.append("\t</programme>\n")
+        return ''.join(parts)
+
+
+def parse_extinf_attributes(line, extra_attributes=None):
+    """Returns all key="value" attributes of #EXTINF line by lower case key, first one wins.
+
+    Attributes which M3uItem doesn't know are added to extra_attributes list as (key, value) in original case.
+    """
+    attributes = {}
+    for key, value in extinf_attribute_pattern.findall(line):
+        lower_key = key.lower()
+        if lower_key not in attributes:
+            attributes[lower_key] = value
+            if extra_attributes is not None and lower_key not in m3u_known_attributes:
+                extra_attributes.append((key, value))
+    return attributes
+
+
+def parse_xmltv_time(value):
+    """Returns (date, hour, minute, second, tzinfo) of xmltv timestamp like '20240125172057 +0000'.
+
+    Same result as datetime.strptime(value, date_format) for full timestamps, raises ValueError on invalid ones.
+    Dates and time/offset suffixes repeat a lot in epg, so both are cached.
+    """
+    day = xmltv_date_cache.get(value[:8])
+    if day is None:
+        day_string = value[:8]
+        if len(day_string) != 8 or not day_string.isdigit():
+            raise ValueError("time data %r is not xmltv timestamp" % value)
+        day = date(int(day_string[:4]), int(day_string[4:6]), int(day_string[6:8]))
+        if len(xmltv_date_cache) > XMLTV_CACHE_SIZE:
+            xmltv_date_cache.clear()
+        xmltv_date_cache[day_string] = day
+
+    suffix = value[8:]
+    time = xmltv_time_cache.get(suffix)
+    if time is None:
+        time = parse_xmltv_time_suffix(value, suffix)
+        if len(xmltv_time_cache) > XMLTV_CACHE_SIZE:
+            xmltv_time_cache.clear()
+        xmltv_time_cache[suffix] = time
+    return (day,) + time
+
+
+def parse_xmltv_time_suffix(value, suffix):
+    match = xmltv_time_pattern.match(suffix)
+    if match is None:
+        raise ValueError("time data %r is not xmltv timestamp" % value)
+    hour, minute, second, offset = match.groups()
+    hour = int(hour) if hour is not None else 0
+    minute = int(minute) if minute is not None else 0
+    second = int(second) if second is not None else 0
+    if hour > 23 or minute > 59 or second > 61:
+        raise ValueError("time data %r is not xmltv timestamp" % value)
+
+    tzinfo = timezone.utc
+    if offset is not None and offset != 'Z':
+        offset = offset.replace(':', '')
+        delta = timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5]))
+        tzinfo = timezone(-delta if offset[0] == '-' else delta)
+    return hour, minute, second, tzinfo
+
+
+def parse_xmltv_date(value):
+    """Date part of xmltv timestamp, same as datetime.strptime(value, date_format).date()"""
+    return parse_xmltv_time(value)[0]
+
+
+def parse_xmltv_datetime(value):
+    """Timezone aware datetime of xmltv timestamp, UTC is assumed when offset is missing"""
+    day, hour, minute, second, tzinfo = parse_xmltv_time(value)
+    return datetime(day.year, day.month, day.day, hour, minute, min(second, 59), tzinfo=tzinfo)
+
+
+def parse_programme_dates(logger, start, stop):
+    """Returns (start_date, stop_date) of programme, None for dates which can't be parsed"""
+    try:
+        start_date = parse_xmltv_date(start)
+    except Exception as error:
+        logger.error("Error in ProgrammeItem, can't parse start: %s, error: %s" % (start, error))
+        start_date = None
+    try:
+        stop_date = parse_xmltv_date(stop)
+    except Exception as error:
+        logger.error("Error in ProgrammeItem, can't parse stop: %s, error: %s" % (stop, error))
+        stop_date = None
+    return start_date, stop_date
+
+
+def is_in_the_future(start_date, today_plus_one_week):
+    return start_date is not None and today_plus_one_week is not None and start_date > today_plus_one_week
+
+
+def is_in_the_past(stop_date, today):
+    return stop_date is not None and today is not None and today > stop_date
+
+
+def is_programme_in_window(dates, today, today_plus_one_week):
+    """Window check on (start_date, stop_date) before ProgrammeItem is created, same as its is_in_the_* flags"""
+    return not is_in_the_past(dates[1], today) and not is_in_the_future(dates[0], today_plus_one_week)
 
 
 def add_sub_element(name, item, root):
@@ -352,6 +526,17 @@ def xml_escape(str_xml: str):
     return str_xml
 
 
+def xml_escape_cached(str_xml: str):
+    """xml_escape() for small set of repeated values, like categories"""
+    escaped = xml_escape_cache.get(str_xml)
+    if escaped is None:
+        escaped = xml_escape(str_xml)
+        if len(xml_escape_cache) > XMLTV_CACHE_SIZE:
+            xml_escape_cache.clear()
+        xml_escape_cache[str_xml] = escaped
+    return escaped
+
+
 def insert_value_if_needed(list, value_to_insert):
     for value in list:
         if value.text == value_to_insert:
@@ -0,0 +1,77 @@
+#!/usr/bin/env python -*- coding: utf-8 -*-
+import tempfile
+
+
+class PendingProgrammes:
+    """Serialized programmes waiting for their channel, by channel id, in file order.
+
+    Programmes are kept in memory up to max_size bytes, then all of them are moved to a temporary file
+    and only their offsets stay in memory.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.memory = {}
+        self.memory_size = 0
+        self.offsets = {}
+        self.file = None
+        self.count = 0
+        self.spilled = 0
+
+    def add(self, channel_id, data):
+        self.memory.setdefault(channel_id, []).append(data)
+        self.memory_size += len(data)
+        self.count += 1
+        if self.memory_size > self.max_size:
+            self.spill()
+
+    def spill(self):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix='pending-')
+        self.file.seek(0, 2)
+        for channel_id, items in self.memory.items():
+            offsets = self.offsets.setdefault(channel_id, [])
+            for data in items:
+                offsets.append((self.file.tell(), len(data)))
+                self.file.write(data)
+                self.spilled += 1
+        self.memory.clear()
+        self.memory_size = 0
+
+    def pop(self, channel_id):
+        """Returns programmes of channel, spilled ones first as they came earlier, and forgets them"""
+        items = []
+        offsets = self.offsets.pop(channel_id, None)
+        if offsets is not None:
+            for offset, length in offsets:
+                self.file.seek(offset)
+                items.append(self.file.read(length))
+        memory_items = self.memory.pop(channel_id, None)
+        if memory_items is not None:
+            for data in memory_items:
+                self.memory_size -= len(data)
+            items.extend(memory_items)
+        self.count -= len(items)
+        return items
+
+    def discard(self, channel_id):
+        """Forgets programmes of channel, returns their number"""
+        count = len(self.offsets.pop(channel_id, ()))
+        memory_items = self.memory.pop(channel_id, None)
+        if memory_items is not None:
+            for data in memory_items:
+                self.memory_size -= len(data)
+            count += len(memory_items)
+        self.count -= count
+        return count
+
+    def close(self):
+        """Removes temporary file, returns number of programmes which never got their channel"""
+        count = self.count
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.memory.clear()
+        self.offsets.clear()
+        self.memory_size = 0
+        self.count = 0
+        return count
@@ -0,0 +1,107 @@
+#!/usr/bin/env python -*- coding: utf-8 -*-
+import cProfile
+import glob
+import json
+import os
+import pstats
+import shutil
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+PROFILE_SUMMARY_FILE = 'summary.json'
+PROFILE_ALL_FILE = 'filter.prof'
+
+
+class FilterProfile:
+    """CPU profile and tracemalloc allocations of one filter run, section by section, written into folder.
+
+    Every section gets its own cProfile file (name.prof) and in summary.json: time, traced memory and peak,
+    top functions by own time and top allocations made during the section and still alive at its end.
+    cProfile sees only the thread running the sections, tracemalloc traces all threads of the process.
+    """
+    def __init__(self, logger, folder, top=25):
+        self.logger = logger
+        self.folder = folder
+        self.id = os.path.basename(os.path.normpath(folder))
+        self.top = top
+        self.created = time.time()
+        self.sections = []
+        self.profile_files = []
+        os.makedirs(folder)
+        self.tracing = not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+        logger.info('FilterProfile(%s), top: %d' % (folder, top))
+
+    @contextmanager
+    def section(self, name):
+        start_snapshot = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        profile = cProfile.Profile()
+        start_time = time.time()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            section_time = time.time() - start_time
+            current, peak = tracemalloc.get_traced_memory()
+            allocations = tracemalloc.take_snapshot().compare_to(start_snapshot, 'lineno')
+            file_name = self.folder + name + '.prof'
+            profile.dump_stats(file_name)
+            self.profile_files.append(file_name)
+            self.sections.append({'name': name, 'time': section_time, 'memory': current, 'memory_peak': peak,
+                                  'functions': get_top_functions(pstats.Stats(profile), self.top),
+                                  'allocations': [{'location': '%s:%d' % (stat.traceback[0].filename, stat.traceback[0].lineno),
+                                                   'size': stat.size_diff, 'count': stat.count_diff}
+                                                  for stat in allocations[:self.top]]})
+            self.logger.info('FilterProfile.section(%s), time: %ss, memory: %d, peak: %d' % (name, section_time, current,
+                                                                                             peak))
+
+    def close(self):
+        """Writes profile of all sections and summary, returns summary dict"""
+        if self.tracing:
+            tracemalloc.stop()
+        summary = self.to_dict()
+        if len(self.profile_files) > 0:
+            all_stats = pstats.Stats(*self.profile_files)
+            all_stats.dump_stats(self.folder + PROFILE_ALL_FILE)
+            summary['functions'] = get_top_functions(all_stats, self.top)
+        with open(self.folder + PROFILE_SUMMARY_FILE, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=1)
+        self.logger.info('FilterProfile.close(%s), sections: %d, time: %ss' % (self.folder, len(self.sections),
+                                                                             time.time() - self.created))
+        return summary
+
+    def to_dict(self):
+        return {'id': self.id, 'created': self.created, 'time': time.time() - self.created,
+                'sections': [dict(section) for section in self.sections]}
+
+
+def get_top_functions(stats, top):
+    """Returns top functions of pstats.Stats by own time: function, calls, time and cumulative time"""
+    functions = []
+    for (file_name, line, function), (primitive_calls, calls, own_time, cumulative_time, callers) in stats.stats.items():
+        functions.append({'function': '%s:%d(%s)' % (file_name, line, function), 'calls': calls, 'time': own_time,
+                          'cumulative_time': cumulative_time})
+    functions.sort(key=lambda item: item['time'], reverse=True)
+    return functions[:top]
+
+
+def get_profiles(folder):
+    """Returns summaries of finished profiles in folder without per function and allocation lists, newest first"""
+    profiles = []
+    for summary_file in sorted(glob.glob(folder + '*/' + PROFILE_SUMMARY_FILE), reverse=True):
+        with open(summary_file, encoding='utf-8') as f:
+            summary = json.load(f)
+        profiles.append({'id': summary['id'], 'created': summary['created'], 'time': summary['time'],
+                         'sections': [{'name': section['name'], 'time': section['time'],
+                                       'memory_peak': section['memory_peak']} for section in summary['sections']]})
+    return profiles
+
+
+def remove_old_profiles(logger, folder, keep):
+    for profile_folder in sorted(glob.glob(folder + '*'))[:-max(keep, 1)]:
+        logger.info("remove_old_profiles(), remove: %s" % profile_folder)
+        shutil.rmtree(profile_folder, ignore_errors=True)
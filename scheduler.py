@@ -0,0 +1,174 @@
+#!/usr/bin/env python -*- coding: utf-8 -*-
+import os
+import random
+import threading
+import time
+import traceback
+
+from utils import download_m3u, download_all_epgs, get_download_timeouts, filter_epg, get_file_hash, \
+    M3U_CACHE_FILE_PATH, EPG_ALL_CACHE_FILE_PATH, EPG_PARSE_WORKERS
+
+# Refresh intervals in minutes, 0 disables refresh of the input
+REFRESH_M3U_INTERVAL = int(os.getenv('REFRESH_M3U_INTERVAL', '0'))
+REFRESH_EPG_INTERVAL = int(os.getenv('REFRESH_EPG_INTERVAL', '0'))
+# Per epg source intervals by source index in tv_epg_urls starting from 1: "3=1440,5=0"
+REFRESH_EPG_INTERVALS = os.getenv('REFRESH_EPG_INTERVALS', '')
+# Random +- part of interval added to every next run
+REFRESH_JITTER = float(os.getenv('REFRESH_JITTER', '0.1'))
+# Failed input is retried after interval * 2^failures minutes, but not later than this
+REFRESH_BACKOFF_MAX = int(os.getenv('REFRESH_BACKOFF_MAX', '720'))
+# Host written into combined epg by scheduled filter, host of the last /filter or /update-filter request when not set
+REFRESH_HOST = os.getenv('REFRESH_HOST', '')
+REFRESH_TICK = 60
+
+
+def parse_intervals(value):
+    """Parses "index=minutes,..." into dict index -> minutes"""
+    intervals = {}
+    for item in value.split(','):
+        if '=' in item:
+            index, minutes = item.split('=', 1)
+            intervals[int(index)] = int(minutes)
+    return intervals
+
+
+class RefreshScheduler:
+    """Refreshes m3u and every epg source on its own interval through job runner 'refresh' jobs.
+
+    filter_epg() is called only when some input changed: epg downloaded with status 200 or m3u with new content.
+    request_host is the host of the last filter, the scheduled filter waits for it when REFRESH_HOST is not set.
+    """
+    def __init__(self, logger, job_runner, m3u_url, tv_epg_urls, request_host=None):
+        self.logger = logger
+        self.job_runner = job_runner
+        self.m3u_url = m3u_url
+        self.tv_epg_urls = tv_epg_urls
+        self.request_host = REFRESH_HOST or request_host
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.job = None
+        self.m3u_hash = get_file_hash(M3U_CACHE_FILE_PATH) if os.path.exists(M3U_CACHE_FILE_PATH) else None
+        self.filter_needed = not os.path.exists(EPG_ALL_CACHE_FILE_PATH)
+
+        self.entries = {}
+        now = time.time()
+        if REFRESH_M3U_INTERVAL > 0:
+            self.entries['m3u'] = self.new_entry(m3u_url, REFRESH_M3U_INTERVAL, now)
+        epg_intervals = parse_intervals(REFRESH_EPG_INTERVALS)
+        for index, url in enumerate(tv_epg_urls, start=1):
+            interval = epg_intervals.get(index, REFRESH_EPG_INTERVAL)
+            if interval > 0:
+                self.entries[index] = self.new_entry(url, interval, now)
+
+    @staticmethod
+    def new_entry(url, interval, now):
+        return {'url': url, 'interval': interval * 60, 'next': now, 'failures': 0, 'status': None, 'last': None,
+                'changed': None}
+
+    def is_enabled(self):
+        return len(self.entries) > 0
+
+    def start(self):
+        if not self.is_enabled():
+            self.logger.info("RefreshScheduler.start(), no refresh intervals set, disabled")
+            return
+        self.logger.info("RefreshScheduler.start(), inputs: %d" % len(self.entries))
+        self.thread = threading.Thread(target=self.loop, name='scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def loop(self):
+        while not self.stop_event.is_set():
+            try:
+                self.tick(time.time())
+            except Exception as e:
+                self.logger.error("RefreshScheduler.loop(), unexpected exception: %s" % repr(e))
+                traceback.print_exc()
+            self.stop_event.wait(self.get_wait_time(time.time()))
+
+    def get_wait_time(self, now):
+        with self.lock:
+            next_run = min(entry['next'] for entry in self.entries.values())
+        return min(max(next_run - now, 1), REFRESH_TICK)
+
+    def get_due(self, now):
+        with self.lock:
+            return [key for key, entry in self.entries.items() if entry['next'] <= now]
+
+    def tick(self, now):
+        if self.job is not None and self.job.is_active():
+            return
+        due = self.get_due(now)
+        if len(due) == 0:
+            return
+        self.logger.info("RefreshScheduler.tick(), due: %s" % due)
+        self.job, created = self.job_runner.submit('refresh', self.refresh_job, due)
+
+    def refresh_job(self, job, due):
+        changed = []
+        if 'm3u' in due:
+            try:
+                stats = download_m3u(self.logger, self.m3u_url, job.stages)
+                m3u_hash = get_file_hash(M3U_CACHE_FILE_PATH)
+                is_changed = m3u_hash != self.m3u_hash
+                self.m3u_hash = m3u_hash
+                self.set_result('m3u', stats['status'], stats['status'] in (200, 304), is_changed)
+                if is_changed:
+                    changed.append('m3u')
+            except Exception as e:
+                self.logger.error("RefreshScheduler.refresh_job(), m3u download failed: %s" % repr(e))
+                self.set_result('m3u', None, False, False)
+
+        indexes = [key for key in due if key != 'm3u']
+        if len(indexes) > 0:
+            stats_list = []
+            try:
+                stats_list = download_all_epgs(self.logger, self.tv_epg_urls, get_download_timeouts(self.tv_epg_urls),
+                                               progress=job.stages, indexes=indexes)
+            finally:
+                for stats in stats_list:
+                    indexes.remove(stats['index'])
+                    is_changed = stats['state'] == 'done' and stats['status'] == 200
+                    self.set_result(stats['index'], stats['status'],
+                                    stats['state'] == 'done' and stats['status'] in (200, 304), is_changed)
+                    if is_changed:
+                        changed.append(stats['index'])
+                for index in indexes:
+                    self.set_result(index, None, False, False)
+
+        if len(changed) > 0:
+            self.filter_needed = True
+        self.logger.info("RefreshScheduler.refresh_job(), changed: %s, filter needed: %s" % (changed, self.filter_needed))
+        if self.filter_needed and not self.request_host:
+            self.logger.error("RefreshScheduler.refresh_job(), filter skipped: set REFRESH_HOST or call /filter once")
+        elif self.filter_needed:
+            filter_epg(self.logger, self.request_host, EPG_PARSE_WORKERS, job.stages)
+            self.filter_needed = False
+
+    def set_filtered(self, request_host):
+        """Called after filter run outside of scheduler, the m3u it used is not a change any more"""
+        if not REFRESH_HOST:
+            self.request_host = request_host
+        self.m3u_hash = get_file_hash(M3U_CACHE_FILE_PATH) if os.path.exists(M3U_CACHE_FILE_PATH) else None
+        self.filter_needed = False
+
+    def set_result(self, key, status, success, changed):
+        """Schedules next run after interval with jitter, failed input after exponential backoff"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries[key]
+            entry['failures'] = 0 if success else entry['failures'] + 1
+            delay = min(entry['interval'] * 2 ** entry['failures'], max(REFRESH_BACKOFF_MAX * 60, entry['interval']))
+            entry['next'] = now + delay * (1 + random.uniform(-REFRESH_JITTER, REFRESH_JITTER))
+            entry.update(status=status, last=now, changed=changed)
+        self.logger.info("RefreshScheduler.set_result(%s), status: %s, changed: %s, failures: %d, next in: %ds" % (
+            key, status, changed, entry['failures'], entry['next'] - now))
+
+    def to_dict(self):
+        with self.lock:
+            entries = {str(key): dict(entry) for key, entry in self.entries.items()}
+        return {'enabled': self.is_enabled(), 'filter_needed': self.filter_needed, 'request_host': self.request_host,
+                'entries': entries, 'job': self.job.id if self.job is not None else None}
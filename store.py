@@ -0,0 +1,158 @@
+#!/usr/bin/env python -*- coding: utf-8 -*-
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from model_items import parse_xmltv_datetime
+
+EPG_STORE_FILE = 'epg.db'
+STORE_BATCH_SIZE = 10000
+
+schema = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE m3u (position INTEGER PRIMARY KEY, name TEXT, tvg_name TEXT, tvg_id TEXT, group_title TEXT,
+                  channel_id TEXT, programmes INTEGER, m3u TEXT);
+CREATE TABLE channels (id TEXT PRIMARY KEY, name TEXT, icon TEXT, programmes INTEGER, xml TEXT);
+CREATE TABLE programmes (channel_id TEXT, start INTEGER, stop INTEGER, title TEXT, desc TEXT, category TEXT, xml TEXT);
+'''
+indexes = '''
+CREATE INDEX m3u_channel_id ON m3u (channel_id);
+CREATE INDEX programmes_channel_start ON programmes (channel_id, start);
+'''
+
+
+def get_first_text(name_items):
+    for name_item in name_items:
+        if name_item.text is not None:
+            return name_item.text
+    return None
+
+
+def get_timestamp(value):
+    """Unix time of xmltv timestamp, None when it can't be parsed"""
+    try:
+        return int(parse_xmltv_datetime(value).timestamp())
+    except Exception:
+        return None
+
+
+class EpgStoreWriter:
+    """Writes merged filter_epg() result into sqlite file next to combined epg in the snapshot folder.
+
+    Rows are inserted in batches in one transaction, indexes are created at the end.
+    """
+    def __init__(self, logger, file_name):
+        self.logger = logger
+        self.file_name = file_name
+        self.tmp_file_name = file_name + '.tmp'
+        if os.path.exists(self.tmp_file_name):
+            os.remove(self.tmp_file_name)
+        self.connection = sqlite3.connect(self.tmp_file_name)
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.executescript(schema)
+        self.m3u_rows = []
+        self.channel_rows = []
+        self.programme_rows = []
+        self.counts = {'m3u': 0, 'channels': 0, 'programmes': 0}
+
+    def add_m3u_item(self, position, m3u_item, m3u):
+        channel_item = m3u_item.get_max_programs()
+        self.m3u_rows.append((position, m3u_item.name, m3u_item.tvg_name, m3u_item.get_tvg_id(), m3u_item.group_title,
+                              channel_item.id if channel_item is not None else None, m3u_item.get_programs_count(), m3u))
+        self.flush_rows(False)
+
+    def add_channel(self, channel_item, xml):
+        name = channel_item.display_name_list[0].text if len(channel_item.display_name_list) > 0 else None
+        self.channel_rows.append((channel_item.id, name, channel_item.icon, len(channel_item.programs), xml))
+        self.flush_rows(False)
+
+    def add_programme(self, programme_item, xml):
+        self.programme_rows.append((programme_item.channel, get_timestamp(programme_item.start),
+                                    get_timestamp(programme_item.stop), get_first_text(programme_item.title_list),
+                                    get_first_text(programme_item.desc_list), get_first_text(programme_item.category_list),
+                                    xml))
+        self.flush_rows(False)
+
+    def flush_rows(self, force):
+        for table, rows, columns in (('m3u', self.m3u_rows, 8), ('channels', self.channel_rows, 5),
+                                     ('programmes', self.programme_rows, 7)):
+            if len(rows) > 0 and (force or len(rows) >= STORE_BATCH_SIZE):
+                self.connection.executemany('INSERT OR IGNORE INTO %s VALUES (%s)' % (table, ','.join('?' * columns)), rows)
+                self.counts[table] += len(rows)
+                rows.clear()
+
+    def close(self, meta):
+        """Writes meta dict and moves finished store to its file name"""
+        self.flush_rows(True)
+        meta = dict(meta, created=time.time(), **self.counts)
+        self.connection.executemany('INSERT INTO meta VALUES (?, ?)', [(key, json.dumps(value)) for key, value in meta.items()])
+        self.connection.executescript(indexes)
+        self.connection.commit()
+        self.connection.close()
+        os.replace(self.tmp_file_name, self.file_name)
+        self.logger.info("EpgStoreWriter.close(%s), %s" % (self.file_name, self.counts))
+
+
+    def abort(self):
+        """Closes store without publishing it"""
+        try:
+            self.connection.close()
+        finally:
+            if os.path.exists(self.tmp_file_name):
+                os.remove(self.tmp_file_name)
+
+
+class EpgStore:
+    """Read only access to the published store, reopened when 'current' snapshot link moves.
+
+    sqlite connections can't be shared between threads, every thread gets its own one.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.local = threading.local()
+
+    def get_connection(self):
+        real_file_name = os.path.realpath(self.file_name)
+        if getattr(self.local, 'file_name', None) != real_file_name:
+            if getattr(self.local, 'connection', None) is not None:
+                self.local.connection.close()
+            self.local.connection = None
+            if os.path.exists(real_file_name):
+                self.local.connection = sqlite3.connect('file:%s?mode=ro' % real_file_name, uri=True)
+            self.local.file_name = real_file_name
+        return self.local.connection
+
+    def open_snapshot(self):
+        """Returns (file name, new connection) of the current store for reading it through in one snapshot,
+        (None, None) when there is no store, connection has to be closed by the caller"""
+        real_file_name = os.path.realpath(self.file_name)
+        if not os.path.exists(real_file_name):
+            return None, None
+        return real_file_name, sqlite3.connect('file:%s?mode=ro' % real_file_name, uri=True, check_same_thread=False)
+
+    def get_meta(self):
+        connection = self.get_connection()
+        if connection is None:
+            return {}
+        return {key: json.loads(value) for key, value in connection.execute('SELECT key, value FROM meta')}
+
+    def get_m3u_items(self):
+        """Returns list of dicts: position, name, tvg_name, tvg_id, group_title, channel_id, programmes"""
+        connection = self.get_connection()
+        if connection is None:
+            return []
+        cursor = connection.execute('SELECT position, name, tvg_name, tvg_id, group_title, channel_id, programmes '
+                                    'FROM m3u ORDER BY position')
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def get_all_programmes(self):
+        """Returns cursor of (channel_id, start, stop, title, desc, category) sorted by channel and start"""
+        connection = self.get_connection()
+        if connection is None:
+            return []
+        return connection.execute('SELECT channel_id, start, stop, title, desc, category FROM programmes '
+                                  'WHERE start IS NOT NULL AND stop IS NOT NULL ORDER BY channel_id, start')
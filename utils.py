@@ -1,7 +1,11 @@
 #!/usr/bin/env python -*- coding: utf-8 -*-
 import gc
 import gzip
+import hashlib
+import multiprocessing
+import pickle
 import traceback
+from contextlib import nullcontext
 from datetime import date, timedelta
 
 import requests
@@ -12,9 +16,27 @@ import re
 import shutil
 import time
 import glob
-from sh import gunzip
-
-from model_items import M3uItem, ChannelItem, ProgrammeItem, NameItem
+import threading
+import zlib
+import lzma
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from logger import get_logger
+from store import EpgStoreWriter, EPG_STORE_FILE
+from merge import merge_channels
+import metrics
+from profiling import FilterProfile, remove_old_profiles
+from pending import PendingProgrammes
+from model_items import M3uItem, M3uIndex, ChannelItem, ExternalChannel, ProgrammeItem, NameItem, \
+    parse_programme_dates, is_programme_in_window
 
 # import xml.etree.ElementTree as ET #cElementTree using c implementation and works faster
 # import xml.etree.cElementTree as ET
@@ -26,28 +48,93 @@ CACHE_FOLDER = 'cache/'
 M3U_FILE = 'm3u.m3u'
 M3U_UPDATED_FILE = 'm3u-updated.m3u'
 EPG_ALL_FILE = 'epg-all.xml'
+# Every filter writes its output into new snapshot folder, 'current' link is switched to it when all files are done
+SNAPSHOTS_FOLDER = CACHE_FOLDER + 'snapshots/'
+CURRENT_SNAPSHOT_LINK = CACHE_FOLDER + 'current'
+SNAPSHOTS_KEEP = int(os.getenv('SNAPSHOTS_KEEP', '2'))
+
 M3U_CACHE_FILE_PATH = CACHE_FOLDER + M3U_FILE
-M3U_UPDATED_CACHE_FILE_PATH = CACHE_FOLDER + M3U_UPDATED_FILE
+M3U_UPDATED_CACHE_FILE_PATH = CURRENT_SNAPSHOT_LINK + '/' + M3U_UPDATED_FILE
 M3U_GZ_CACHE_FILE_PATH = CACHE_FOLDER + M3U_FILE + '.gz'
-M3U_UPDATED_GZ_CACHE_FILE_PATH = CACHE_FOLDER + M3U_UPDATED_FILE + '.gz'
-EPG_ALL_CACHE_FILE_PATH = CACHE_FOLDER + EPG_ALL_FILE
-EPG_ALL_GZ_CACHE_FILE_PATH = CACHE_FOLDER + EPG_ALL_FILE + '.gz'
-
-
-def download_file(logger, url, file_name):
+M3U_UPDATED_GZ_CACHE_FILE_PATH = CURRENT_SNAPSHOT_LINK + '/' + M3U_UPDATED_FILE + '.gz'
+EPG_ALL_CACHE_FILE_PATH = CURRENT_SNAPSHOT_LINK + '/' + EPG_ALL_FILE
+EPG_ALL_GZ_CACHE_FILE_PATH = CURRENT_SNAPSHOT_LINK + '/' + EPG_ALL_FILE + '.gz'
+EPG_STORE_CACHE_FILE_PATH = CURRENT_SNAPSHOT_LINK + '/' + EPG_STORE_FILE
+# Profiles of filter runs, one folder per run
+PROFILES_FOLDER = CACHE_FOLDER + 'profiles/'
+
+# Download settings, (connect, read) timeout in seconds
+DOWNLOAD_TIMEOUT = (5, 30)
+# Per epg source timeouts by its index starting from 1, "index=connect:read" or "index=read", e.g. "3=10:60,5=120"
+DOWNLOAD_TIMEOUTS = os.getenv('DOWNLOAD_TIMEOUTS', '')
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '4'))
+DOWNLOAD_PER_HOST = int(os.getenv('DOWNLOAD_PER_HOST', '2'))
+DOWNLOAD_RETRIES = int(os.getenv('DOWNLOAD_RETRIES', '3'))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Keep matched channels and programmes of every epg source to skip parsing of not changed sources
+EPG_PARSED_CACHE = os.getenv('EPG_PARSED_CACHE', '1') == '1'
+# Version of pickled parse results, changed together with parsed classes and load_xmlt()
+PARSED_CACHE_VERSION = 3
+# Megabytes of programmes kept in memory while their channel is not parsed yet, the rest waits in a temporary file
+EPG_PENDING_SIZE = int(os.getenv('EPG_PENDING_SIZE', '64')) * 1024 * 1024
+# Extra display names of epg channels, json: {"channel id": [{"name": "..", "lang": "en", "if_lang": "en"}]}
+ALIASES_FILE = os.getenv('ALIASES_FILE', 'aliases.json')
+# Sort programmes of every channel, drop duplicates and cut overlaps before writing them
+EPG_MERGE = os.getenv('EPG_MERGE', '1') == '1'
+# Fill gaps between programmes with ones from other epg sources matched to the same m3u channel
+EPG_FILL_GAPS = os.getenv('EPG_FILL_GAPS', '0') == '1'
+# Keep merged channels and programmes in sqlite store next to combined epg
+EPG_STORE = os.getenv('EPG_STORE', '1') == '1'
+# Number of processes parsing epg sources, 1 to parse them one by one in the current process
+EPG_PARSE_WORKERS = int(os.getenv('EPG_PARSE_WORKERS', '1'))
+# Capture cpu profile and allocations of every filter run, single run can be profiled with /filter?profile=1
+EPG_PROFILE = os.getenv('EPG_PROFILE', '0') == '1'
+# Number of functions and allocation places in profile summary
+PROFILE_TOP = int(os.getenv('PROFILE_TOP', '25'))
+PROFILES_KEEP = int(os.getenv('PROFILES_KEEP', '10'))
+# Programmes starting later than this number of days from today are not included into combined epg
+EPG_WINDOW_DAYS = int(os.getenv('EPG_WINDOW_DAYS', '7'))
+# Keep .gz epg sources compressed in the cache and parse them from the compressed file
+EPG_KEEP_COMPRESSED = os.getenv('EPG_KEEP_COMPRESSED', '1') == '1'
+EPG_SOURCE_EXTENSIONS = ('.xml', '.xml.gz', '.xml.xz', '.xml.zst')
+# Output files are written in chunks of this size together with their gzip copy
+WRITE_BUFFER_SIZE = 1024 * 1024
+GZIP_COMPRESS_LEVEL = int(os.getenv('GZIP_COMPRESS_LEVEL', '6'))
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def get_download_session(pool_size=DOWNLOAD_WORKERS):
+    retry = Retry(total=DOWNLOAD_RETRIES, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['GET'])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.verify = False
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def download_file(logger, url, file_name, session=None, timeout=DOWNLOAD_TIMEOUT, stats=None, keep_compressed=False):
     logger.info("download_file(%s, %s)" % (url, file_name))
+    if session is None:
+        session = requests
+    if stats is None:
+        stats = {}
 
     file_name = CACHE_FOLDER + file_name
     file_name_no_gz = file_name.replace('.gz', '')
+    cached_file_name = file_name if keep_compressed else file_name_no_gz
+    stale_file_name = file_name_no_gz if keep_compressed else file_name
 
     etag_file_name, file_extension = os.path.splitext(file_name)
     etag_file_name = etag_file_name + '.etag'
     data = load_last_modified_data(logger, etag_file_name)
     headers = {}
     if data is not None:
-        file_name_no_gz = file_name.replace('.gz', '')
-        if os.path.exists(file_name_no_gz):
-            if 'etag' in data:
+        if os.path.exists(cached_file_name):
+            if 'etag' in data and data['etag'] != 'None':
                 headers['If-None-Match'] = data['etag']
             if data['last_modified'] != 'None':
                 headers['If-Modified-Since'] = data['last_modified']
@@ -55,23 +142,112 @@ def download_file(logger, url, file_name):
     if not os.path.exists(CACHE_FOLDER):
         os.makedirs(CACHE_FOLDER)
 
-    get_response = requests.get(url, headers=headers, verify=False, stream=False, timeout=(5, 30))
-    logger.info("download_file(%s), response: %s" % (url, get_response))
-    if get_response.status_code == 304:
-        logger.info("download_file(%s) ignore as file 'Not Modified'" % url)
-        return file_name_no_gz
+    with session.get(url, headers=headers, verify=False, stream=True, timeout=timeout) as get_response:
+        logger.info("download_file(%s), response: %s" % (url, get_response))
+        stats['status'] = get_response.status_code
+        stats['bytes'] = 0
+        if get_response.status_code == 304:
+            logger.info("download_file(%s) ignore as file 'Not Modified'" % url)
+            return cached_file_name
+        if get_response.status_code != 200:
+            # Error page must not replace the cached file and its etag
+            raise Exception("download_file(%s), unexpected status: %d" % (url, get_response.status_code))
+
+        # .gz files are either kept as is or decompressed while downloading, only one of them is kept in the cache
+        logger.info("download_file(%s) downloading file_name: %s" % (url, cached_file_name))
+        chunks = count_bytes(get_response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE), stats)
+        if file_name != file_name_no_gz and not keep_compressed:
+            chunks = gunzip_chunks(chunks)
+        tmp_file_name = cached_file_name + '.tmp'
+        with open(tmp_file_name, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        if cached_file_name != file_name_no_gz and get_compression(tmp_file_name) is None:
+            # Server already decoded gzip with Content-Encoding
+            cached_file_name, stale_file_name = file_name_no_gz, file_name
+        os.replace(tmp_file_name, cached_file_name)
+        if stale_file_name != cached_file_name and os.path.exists(stale_file_name):
+            os.remove(stale_file_name)
+
+        store_last_modified_data(logger, etag_file_name, get_response.headers)
+
+    file_size = os.path.getsize(cached_file_name)
+    stats['size'] = file_size
+    logger.info("download_file(%s) done: %s, downloaded: %d (%s), file size: %d (%s)" % (
+        url, cached_file_name, stats['bytes'], sizeof_fmt(stats['bytes']), file_size, sizeof_fmt(file_size)))
+    return cached_file_name
+
+
+def count_bytes(chunks, stats):
+    for chunk in chunks:
+        if chunk:
+            stats['bytes'] += len(chunk)
+            yield chunk
+
+
+def gunzip_chunks(chunks, max_length=DOWNLOAD_CHUNK_SIZE):
+    """Decompresses gzip stream chunk by chunk, yielding at most max_length bytes at a time.
+
+    Data that doesn't start with gzip header (e.g. already decoded because of Content-Encoding) is passed as is.
+    """
+    decompressor = None
+    for chunk in chunks:
+        if decompressor is None:
+            if not chunk.startswith(GZIP_MAGIC):
+                yield chunk
+                yield from chunks
+                return
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        while chunk:
+            data = decompressor.decompress(chunk, max_length)
+            if data:
+                yield data
+            if decompressor.eof:
+                # Concatenated gzip members
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                chunk = decompressor.unconsumed_tail
+
+    if decompressor is not None:
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+def get_compression(file_name):
+    with open(file_name, 'rb') as f:
+        header = f.read(6)
+    if header.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if header.startswith(XZ_MAGIC):
+        return 'xz'
+    if header.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
 
-    store_last_modified_data(logger, etag_file_name, get_response.headers)
 
-    logger.info("download_file(%s) downloading file_name: %s" % (url, file_name))
-    with open(file_name, 'wb') as f:
-        for chunk in get_response.iter_content(chunk_size=1024 * 1024):
-            if chunk:
-                f.write(chunk)
+def open_epg_file(file_name):
+    """Opens epg source for reading as binary stream, transparently decompressing gzip, xz and zstd files."""
+    compression = get_compression(file_name)
+    if compression == 'gzip':
+        return gzip.open(file_name, 'rb')
+    if compression == 'xz':
+        return lzma.open(file_name, 'rb')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise Exception("zstandard package is required to read: %s" % file_name)
+        return zstandard.ZstdDecompressor().stream_reader(open(file_name, 'rb'), closefd=True)
+    return open(file_name, 'rb')
+
 
-    file_size = os.path.getsize(file_name)
-    logger.info("download_file(%s) done: %s, file size: %d (%s)" % (url, file_name, file_size, sizeof_fmt(file_size)))
-    return file_name
+def get_epg_source_files():
+    files = []
+    for file in glob.glob(CACHE_FOLDER + 'epg-*'):
+        if file.endswith(EPG_SOURCE_EXTENSIONS) and EPG_ALL_FILE not in file:
+            files.append(file)
+    return sorted(files, key=num_sort)
 
 
 def load_last_modified_data(logger, file_name):
@@ -93,41 +269,129 @@ def store_last_modified_data(logger, file_name, headers):
         json_file.write(json.dumps(data))
 
 
-def download_all_epgs(logger, tv_epg_urls):
-    logger.info("download_all_epgs()")
+def download_m3u(logger, url, progress=None):
+    """Downloads m3u playlist and its gzip copy, returns stats dict: stage, state, index, url, file, status, bytes, time"""
     start_time = time.time()
-    index = 1
-    downloaded_list = []
-    for url in tv_epg_urls:
-        download_epg(logger, index, url, downloaded_list)
-        index = index + 1
-    logger.info("download_all_epgs(), done, time: %sms" % (time.time() - start_time))
-    return downloaded_list
+    stats = {'stage': 'download', 'state': 'running', 'index': 0, 'url': url, 'file': None, 'status': None,
+             'bytes': 0, 'time': 0.0}
+    if progress is not None:
+        progress.append(stats)
+    try:
+        m3u_filename = download_file(logger, url, M3U_FILE, stats=stats)
+    except Exception:
+        stats.update(state='failed', time=time.time() - start_time)
+        observe_download('m3u', stats)
+        raise
+
+    gzip_file(m3u_filename, M3U_GZ_CACHE_FILE_PATH)
+    file_size = os.path.getsize(M3U_GZ_CACHE_FILE_PATH)
+    logger.info("download_m3u(), m3u gz file: %s, size: %s (%s)" % (M3U_GZ_CACHE_FILE_PATH, file_size, sizeof_fmt(file_size)))
+    stats.update(state='done', file=m3u_filename, time=time.time() - start_time)
+    observe_download('m3u', stats)
+    return stats
+
+
+def get_download_timeouts(tv_epg_urls, value=DOWNLOAD_TIMEOUTS):
+    """Returns dict url -> (connect, read) timeout for download_all_epgs() from DOWNLOAD_TIMEOUTS format"""
+    timeouts = {}
+    for item in value.split(','):
+        if '=' in item:
+            index, timeout = item.split('=', 1)
+            url_index = int(index) - 1
+            if 0 <= url_index < len(tv_epg_urls):
+                if ':' in timeout:
+                    connect, read = timeout.split(':', 1)
+                    timeouts[tv_epg_urls[url_index]] = (float(connect), float(read))
+                else:
+                    timeouts[tv_epg_urls[url_index]] = (DOWNLOAD_TIMEOUT[0], float(timeout))
+    return timeouts
+
+
+def download_all_epgs(logger, tv_epg_urls, timeouts=None, workers=DOWNLOAD_WORKERS, per_host=DOWNLOAD_PER_HOST,
+                      progress=None, indexes=None):
+    """Downloads all epgs in parallel with one pooled session, at most per_host downloads at a time from one host.
+
+    timeouts is an optional dict of url -> (connect, read) timeout, DOWNLOAD_TIMEOUT is used for other urls.
+    indexes is an optional collection of source indexes (starting from 1) to download, other sources are skipped.
+    Returns list of per source stats dicts: stage, state, index, url, file, status, bytes, time.
+    Stats dicts are appended to progress list before downloads start and updated while they run.
+    """
+    logger.info("download_all_epgs(), workers: %d, per_host: %d" % (workers, per_host))
+    start_time = time.time()
+    if timeouts is None:
+        timeouts = {}
 
+    host_limits = {}
+    for url in tv_epg_urls:
+        host = urlparse(url).netloc
+        if host not in host_limits:
+            host_limits[host] = threading.BoundedSemaphore(per_host)
 
-def download_epg(logger, index, url, downloaded_list):
+    downloaded_list = []
+    stats_list = []
+    with get_download_session(max(workers, 1)) as session:
+        with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='download') as executor:
+            for index, url in enumerate(tv_epg_urls, start=1):
+                if indexes is not None and index not in indexes:
+                    continue
+                stats = {'stage': 'download', 'state': 'queued', 'index': index, 'url': url, 'file': None,
+                         'status': None, 'bytes': 0, 'time': 0.0}
+                stats_list.append(stats)
+                if progress is not None:
+                    progress.append(stats)
+                executor.submit(download_epg, logger, index, url, downloaded_list, session=session,
+                                timeout=timeouts.get(url, DOWNLOAD_TIMEOUT), host_limit=host_limits[urlparse(url).netloc],
+                                stats=stats)
+
+    downloaded_list.sort(key=num_sort)
+    for stats in sorted(stats_list, key=lambda item: item['time'], reverse=True):
+        logger.info("download_all_epgs(), %d. status: %s, bytes: %d (%s), time: %.2fs, url: %s" % (
+            stats['index'], stats['status'], stats['bytes'], sizeof_fmt(stats['bytes']), stats['time'], stats['url']))
+    logger.info("download_all_epgs(), done, time: %ss" % (time.time() - start_time))
+    metrics.stage_seconds.observe(time.time() - start_time, 'download')
+    return stats_list
+
+
+def download_epg(logger, index, url, downloaded_list, session=None, timeout=DOWNLOAD_TIMEOUT, host_limit=None, stats=None):
     logger.info("download_epg(%s)" % url)
     start_time = time.time()
+    if stats is None:
+        stats = {}
 
     file_name = 'epg-' + str(index) + '.xml'
     if url.endswith('.gz'):
         file_name += '.gz'
+    stats['state'] = 'running'
     try:
-        file_name = download_file(logger, url, file_name)
-
-        if file_name.endswith('.gz'):
-            xml_file_name = file_name.replace('.gz', '')
-            if os.path.exists(xml_file_name):
-                os.remove(xml_file_name)
-            gunzip(file_name)
-            file_name = xml_file_name
+        if host_limit is not None:
+            with host_limit:
+                file_name = download_file(logger, url, file_name, session, timeout, stats, EPG_KEEP_COMPRESSED)
+        else:
+            file_name = download_file(logger, url, file_name, session, timeout, stats, EPG_KEEP_COMPRESSED)
 
+        stats['file'] = file_name
         downloaded_list.append(file_name)
-        logger.info("download_epg(%s), xml size: %s" % (url, sizeof_fmt(os.path.getsize(file_name))))
+        logger.info("download_epg(%s), file: %s, size: %s" % (url, file_name, sizeof_fmt(os.path.getsize(file_name))))
+        stats['state'] = 'done'
     except Exception as e:
         logger.error('ERROR in download_epg(%s) %s' % (url, e))
         traceback.print_exc()
-    logger.info("download_epg(%s), time: %sms" % (url, time.time() - start_time))
+        stats['state'] = 'failed'
+    stats['time'] = time.time() - start_time
+    observe_download('epg-' + str(index), stats)
+    logger.info("download_epg(%s), time: %ss" % (url, stats['time']))
+
+
+def get_source_name(file_name):
+    """Metrics label of downloaded file: its name without folder and extensions, e.g. epg-1"""
+    return os.path.basename(file_name).split('.')[0]
+
+
+def observe_download(source, stats):
+    """Adds download stats dict to metrics, status 0 is a failed download without response"""
+    metrics.download_seconds.observe(stats['time'], source)
+    metrics.download_bytes.inc(source, amount=stats.get('bytes', 0))
+    metrics.download_responses.inc(source, str(stats.get('status') or 0))
 
 
 def sizeof_fmt(num, suffix='B'):
@@ -216,15 +480,6 @@ def is_channel_present_in_list_by_id(channel_list, channel_item):
     return False
 
 
-def is_channel_present_in_m3u(channel_item, m3u_list):
-    return_value = False
-    for value in m3u_list:
-        if value.process(channel_item):
-            if not return_value:
-                return_value = True
-    return return_value
-
-
 def insert_value_if_needed(list, value_to_insert):
     for value in list:
         if value.text == value_to_insert:
@@ -241,136 +496,459 @@ def display_list_has_language(list, param):
     return False
 
 
-def add_custom_entries(channel_item):
-    if channel_item.id == 'ITV1Anglia.uk':
-        channel_item.display_name_list.append(NameItem('itv 1 HD', 'en'))
-    elif channel_item.id == 'ITV2.uk':
-        channel_item.display_name_list.append(NameItem('itv 2 HD', 'en'))
-    elif channel_item.id == 'ITV4.uk':
-        channel_item.display_name_list.append(NameItem('itv 4', 'en'))
-    elif channel_item.id == 'ITV4Plus1.uk':
-        channel_item.display_name_list.append(NameItem('itv 4 +1', 'en'))
-    elif channel_item.id == 'ITV3Plus1.uk':
-        channel_item.display_name_list.append(NameItem('itv 3 +1', 'en'))
-    elif channel_item.id == 'ITVBe.uk':
-        channel_item.display_name_list.append(NameItem('itv BE', 'en'))
-    elif channel_item.id == '1598':
-        channel_item.display_name_list.append(NameItem('Че!', 'ru'))
-    elif channel_item.id == '5kanal-ru-pl4':
-        channel_item.display_name_list.append(NameItem('5 канал +4', 'ru'))
-    elif channel_item.id == '1803':
-        channel_item.display_name_list.append(NameItem('Любимое ТВ HD', 'ru'))
-    elif channel_item.id == '8242':
-        channel_item.display_name_list.append(NameItem('BBC 1 HD', 'en'))
-    elif channel_item.id == '8243':
-        channel_item.display_name_list.append(NameItem('BBC 2 HD', 'en'))
-    elif channel_item.id == 'BBCALBAHD.uk':
-        channel_item.display_name_list.append(NameItem('BBC Alba HD', 'en'))
-    elif channel_item.id == 'BBCOne.uk':
-        channel_item.display_name_list.append(NameItem('BBC First HD', 'en'))
-    elif channel_item.id == 'M+ Golf':
-        channel_item.display_name_list.append(NameItem('Movistar Golf HD ES', 'es'))
-    elif channel_item.id == 'M+ LALIGA TV':
-        channel_item.display_name_list.append(NameItem('Movistar LaLiga HD ES', 'es'))
-    elif channel_item.id == 'M+ Liga de Campeones':
-        channel_item.display_name_list.append(NameItem('Movistar Liga Campeones HD ES', 'es'))
-    elif channel_item.id == 'M+ Drama':
-        channel_item.display_name_list.append(NameItem('Movistar Drama ES', 'es'))
-    elif channel_item.id == 'El Toro TV':
-        channel_item.display_name_list.append(NameItem('TOROS ES', 'es'))
-    elif channel_item.id == 'Comedy Central' and display_list_has_language(channel_item.display_name_list, 'es'):
-        channel_item.display_name_list.append(NameItem('Comedy Central HD ES', 'es'))
-    elif channel_item.id == 'COSMO' and display_list_has_language(channel_item.display_name_list, 'es'):
-        channel_item.display_name_list.append(NameItem('Cosmopolitan HD ES', 'es'))
-    elif channel_item.id == 'GOL PLAY':
-        channel_item.display_name_list.append(NameItem('GOL ES', 'es'))
-    elif channel_item.id == 'Cuatro':
-        channel_item.display_name_list.append(NameItem('Cuatro HD ES', 'es'))
-    elif channel_item.id == 'Telecinco':
-        channel_item.display_name_list.append(NameItem('Telecinco HD ES', 'es'))
-    elif channel_item.id == 'Atreseries':
-        channel_item.display_name_list.append(NameItem('atreseries HD ES', 'es'))
-    elif channel_item.id == 'BE MAD':
-        channel_item.display_name_list.append(NameItem('BeMad tv HD ES', 'es'))
-    elif channel_item.id == 'Real Madrid TV':
-        channel_item.display_name_list.append(NameItem('Real Madrid TV HD ES', 'es'))
-    pass
-
-
-def load_xmlt(logger, today, today_plus_one_week, m3u_list, epg_file, channel_map, programme_list):
+def load_aliases(logger, file_name=ALIASES_FILE):
+    """Returns (aliases, hash) of aliases file: channel id -> list of (name, lang, if_lang) display names to add.
+
+    Display name is added only when channel already has a display name in if_lang, if it is set.
+    """
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    aliases = {}
+    for channel_id, entries in json.loads(data.decode('utf-8')).items():
+        aliases[channel_id] = [(entry['name'], entry.get('lang'), entry.get('if_lang')) for entry in entries]
+    logger.info('load_aliases(%s), channels: %d' % (file_name, len(aliases)))
+    return aliases, hashlib.sha1(data).hexdigest()
+
+
+aliases_state = {'mtime': None, 'aliases': {}, 'hash': None}
+
+
+def get_aliases(logger, file_name=ALIASES_FILE):
+    """Returns (aliases, hash), aliases file is read again when it was changed, previous aliases are kept on errors"""
+    try:
+        mtime = os.stat(file_name).st_mtime_ns
+        if mtime != aliases_state['mtime']:
+            aliases_state['aliases'], aliases_state['hash'] = load_aliases(logger, file_name)
+            aliases_state['mtime'] = mtime
+    except Exception as e:
+        logger.error('get_aliases(%s), unexpected exception: %s' % (file_name, repr(e)))
+    return aliases_state['aliases'], aliases_state['hash']
+
+
+def add_aliases(channel_item, aliases):
+    entries = aliases.get(channel_item.id)
+    if entries is not None:
+        for name, lang, if_lang in entries:
+            if if_lang is None or display_list_has_language(channel_item.display_name_list, if_lang):
+                channel_item.display_name_list.append(NameItem(name, lang))
+
+
+def load_xmlt(logger, today, today_plus_one_week, m3u_index, epg_file, channel_map, stats, events=None,
+              foreign_ids=None, aliases=None):
+    """Parses epg_file, adds matched channels to channel_map and in window programmes to their channels.
+
+    Channels get display names from aliases before matching, current aliases file is used when it is None.
+
+    Programmes which come before their <channel> wait in PendingProgrammes until it is parsed, in one pass.
+
+    stats['programmes'] counts added programmes, stats['channels'] and stats['matched'] count seen and matched channels,
+    stats['out_of_window'] and stats['unknown_channel'] count dropped programmes, stats['rescued'] counts added ones
+    which came before their channel and stats['spilled'] ones which waited for it on disk.
+
+    When events list is provided, it records ('channel', channel_item, m3u positions) for every matched channel and
+    ('programme', program_item) for programmes added to channels from previous sources, see replay_xmlt_events().
+    foreign_ids collects channel ids of programmes which don't belong to a channel matched earlier in this file.
+    """
     logger.info("load_xmlt(%s)" % epg_file)
     start_time = time.time()
 
+    if aliases is None:
+        aliases = get_aliases(logger)[0]
     count = 0
-    for event, element in ET.iterparse(epg_file, tag=('channel', 'programme'), huge_tree=True):
-        if element.tag == 'channel':
-            channel_item = ChannelItem(element)
-            add_custom_entries(channel_item)
-
-            channel_present = is_channel_present_in_m3u(channel_item, m3u_list)
-            if channel_present:
-                channel_map[channel_item.id] = channel_item
-                # logger.info('load_xmlt(%s), channel_list size: %d' % (epg_file, len(channel_list)))
-            count += 1
-
-        elif element.tag == 'programme':
-            channel_id = element.attrib['channel']
-            if channel_id in channel_map:
-                program_item = ProgrammeItem(logger, today, today_plus_one_week, element)
-                if not program_item.is_in_the_past and not program_item.is_in_the_future_one_week:
-                    programme_list.append(program_item)
-                    channel_map[channel_id].add_program(program_item)
-                    # logger.info('load_xmlt(%s), programme_list size: %d' % (epg_file, len(programme_list)))
+    local_channels = set()
+    seen_ids = set()
+    seen = 0
+    out_of_window = 0
+    unknown_channel = 0
+    rescued = 0
+    pending = PendingProgrammes(EPG_PENDING_SIZE)
+    with open_epg_file(epg_file) as epg_stream:
+        for event, element in ET.iterparse(epg_stream, tag=('channel', 'programme'), huge_tree=True):
+            if element.tag == 'channel':
+                channel_item = ChannelItem(element)
+                add_aliases(channel_item, aliases)
+                seen += 1
+                seen_ids.add(channel_item.id)
+
+                m3u_positions = m3u_index.match(channel_item)
+                if m3u_positions:
+                    channel_map[channel_item.id] = channel_item
+                    local_channels.add(channel_item.id)
+                    if events is not None:
+                        events.append(('channel', channel_item, m3u_positions))
+                    items = pending.pop(channel_item.id)
+                    if items:
+                        # Programmes of the channel are parsed back at once
+                        for programme in ET.fromstring(b''.join([b'<tv>'] + items + [b'</tv>'])):
+                            channel_item.add_program(ProgrammeItem(logger, today, today_plus_one_week, programme))
+                        stats['programmes'] += len(items)
+                        rescued += len(items)
+                    # logger.info('load_xmlt(%s), channel_list size: %d' % (epg_file, len(channel_list)))
+                else:
+                    unknown_channel += pending.discard(channel_item.id)
                 count += 1
 
-        element.clear()
-        if count > 20000:
-            gc.collect()
-            count = 0
-
-    logger.info('load_xmlt(%s), channel_map size: %d, programme_list: %d, time: %sms ' % (epg_file, len(channel_map), len(programme_list), time.time() - start_time))
+            elif element.tag == 'programme':
+                channel_id = element.attrib['channel']
+                if foreign_ids is not None and channel_id not in local_channels:
+                    foreign_ids.add(channel_id)
+                if channel_id in channel_map:
+                    # Window is checked on raw start/stop, so programmes out of it are never created
+                    dates = parse_programme_dates(logger, element.attrib['start'], element.attrib['stop'])
+                    if is_programme_in_window(dates, today, today_plus_one_week):
+                        program_item = ProgrammeItem(logger, today, today_plus_one_week, element, dates)
+                        stats['programmes'] += 1
+                        channel_map[channel_id].add_program(program_item)
+                        if events is not None and channel_id not in local_channels:
+                            events.append(('programme', program_item))
+                    else:
+                        out_of_window += 1
+                    count += 1
+                elif channel_id not in seen_ids:
+                    # Channel can still come later in this file, programme waits for it serialized
+                    dates = parse_programme_dates(logger, element.attrib['start'], element.attrib['stop'])
+                    if is_programme_in_window(dates, today, today_plus_one_week):
+                        pending.add(channel_id, ET.tostring(element, with_tail=False))
+                    else:
+                        out_of_window += 1
+                    count += 1
+                else:
+                    unknown_channel += 1
+
+            element.clear()
+            if count > 20000:
+                gc.collect()
+                count = 0
+
+    spilled = pending.spilled
+    unknown_channel += pending.close()
+    for key, value in (('channels', seen), ('matched', len(local_channels)), ('out_of_window', out_of_window),
+                       ('unknown_channel', unknown_channel), ('rescued', rescued), ('spilled', spilled)):
+        stats[key] = stats.get(key, 0) + value
+    logger.info('load_xmlt(%s), channel_map size: %d, programmes: %d, time: %ss ' % (epg_file, len(channel_map), stats['programmes'], time.time() - start_time))
     gc.collect()
 
 
+def get_parsed_cache_key(epg_file, m3u_hash, aliases_hash, today, today_plus_one_week):
+    """Key of parse_epg_source() result: result format, source file version, m3u content, aliases and time window"""
+    stat = os.stat(epg_file)
+    base_name = epg_file[:epg_file.index('.xml')]
+    etag = None
+    for etag_file_name in (base_name + '.etag', base_name + '.xml.etag'):
+        if os.path.exists(etag_file_name):
+            with codecs.open(etag_file_name, encoding='utf-8') as etag_file:
+                etag = etag_file.read()
+    return {'version': PARSED_CACHE_VERSION, 'file': epg_file, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+            'etag': etag, 'm3u': m3u_hash, 'aliases': aliases_hash, 'today': str(today),
+            'today_plus_one_week': str(today_plus_one_week)}
+
+
+def get_file_hash(file_name):
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_parsed_cache_file(epg_file):
+    return epg_file[:epg_file.index('.xml')] + '.parsed'
+
+
+def load_parsed_cache(logger, epg_file, key):
+    parsed_file = get_parsed_cache_file(epg_file)
+    if not os.path.exists(parsed_file):
+        return None
+    try:
+        with open(parsed_file, 'rb') as f:
+            parsed = pickle.load(f)
+        if parsed['key'] == key:
+            result = parsed['result']
+            result['cached'] = True
+            return result
+    except Exception as e:
+        logger.error('load_parsed_cache(%s), can\'t read parsed cache: %s' % (epg_file, repr(e)))
+    return None
+
+
+def store_parsed_cache(epg_file, key, result):
+    parsed_file = get_parsed_cache_file(epg_file)
+    tmp_file_name = parsed_file + '.tmp'
+    with open(tmp_file_name, 'wb') as f:
+        pickle.dump({'key': key, 'result': result}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file_name, parsed_file)
+
+
+def parse_epg_source(logger, today, today_plus_one_week, m3u_index, epg_file, known_ids, aliases):
+    """Parses one epg source on its own, known_ids are channel ids matched in the previous sources.
+
+    Returns dict with load_xmlt() events and stats, matched_ids of this source, foreign_ids of its programmes and
+    used_ids - foreign ids from known_ids, result stays valid while foreign_ids & previous ids == used_ids.
+    """
+    start_time = time.time()
+    channel_map = {}
+    for channel_id in known_ids:
+        channel_map[channel_id] = ExternalChannel(channel_id)
+    events = []
+    foreign_ids = set()
+    stats = {'programmes': 0}
+    load_xmlt(logger, today, today_plus_one_week, m3u_index, epg_file, channel_map, stats, events, foreign_ids, aliases)
+
+    matched_ids = set()
+    for event in events:
+        if event[0] == 'channel':
+            matched_ids.add(event[1].id)
+    return {'file': epg_file, 'events': events, 'matched_ids': matched_ids, 'foreign_ids': foreign_ids,
+            'used_ids': foreign_ids & set(known_ids), 'stats': stats, 'time': time.time() - start_time,
+            'pid': os.getpid()}
+
+
+def is_parsed_result_valid(result, previous_ids):
+    return result is not None and result['foreign_ids'] & previous_ids == result['used_ids']
+
+
+def replay_xmlt_events(m3u_index, events, channel_map, stats):
+    """Applies load_xmlt() events to channel_map, stats and m3u items the same way parsing did"""
+    m3u_list = m3u_index.m3u_list
+    for event in events:
+        if event[0] == 'channel':
+            channel_item = event[1]
+            channel_map[channel_item.id] = channel_item
+            stats['programmes'] += len(channel_item.programs)
+            for position in event[2]:
+                m3u_list[position].channels[channel_item.id] = channel_item
+        else:
+            program_item = event[1]
+            stats['programmes'] += 1
+            channel_map[program_item.channel].add_program(program_item)
+
+
+worker_state = {}
+
+
+def parse_epg_source_worker(today, today_plus_one_week, m3u_hash, epg_file, known_ids, aliases):
+    """parse_epg_source() in a worker process, m3u is parsed once per process"""
+    if 'logger' not in worker_state:
+        worker_state['logger'] = get_logger('iptv-helper-worker')
+    logger = worker_state['logger']
+    if worker_state.get('m3u_hash') != m3u_hash:
+        if get_file_hash(M3U_CACHE_FILE_PATH) != m3u_hash:
+            raise Exception("m3u file changed: %s" % M3U_CACHE_FILE_PATH)
+        worker_state['m3u_index'] = M3uIndex(parse_m3u(logger, M3U_CACHE_FILE_PATH))
+        worker_state['m3u_hash'] = m3u_hash
+    return parse_epg_source(logger, today, today_plus_one_week, worker_state['m3u_index'], epg_file, known_ids, aliases)
+
+
+def parse_epg_sources_in_pool(logger, today, today_plus_one_week, m3u_hash, known_ids_map, workers, aliases):
+    """Parses epg sources (file -> known ids) in process pool, returns file -> result, None for failed sources"""
+    results = {}
+    if len(known_ids_map) == 0:
+        return results
+    logger.info('parse_epg_sources_in_pool(), sources: %d, workers: %d' % (len(known_ids_map), workers))
+    with ProcessPoolExecutor(max_workers=min(workers, len(known_ids_map)), mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {}
+        for epg_file, known_ids in known_ids_map.items():
+            futures[epg_file] = executor.submit(parse_epg_source_worker, today, today_plus_one_week, m3u_hash, epg_file,
+                                               known_ids, aliases)
+        for epg_file, future in futures.items():
+            try:
+                result = future.result()
+                logger.info('parse_epg_sources_in_pool(%s), worker pid: %d, channels: %d, time: %ss' % (
+                    epg_file, result['pid'], len(result['matched_ids']), result['time']))
+                results[epg_file] = result
+            except Exception as e:
+                logger.error('parse_epg_sources_in_pool(%s), unexpected exception: %s' % (epg_file, repr(e)))
+                results[epg_file] = None
+    return results
+
+
+def load_epg_sources(logger, today, today_plus_one_week, m3u_index, m3u_hash, files, channel_map, stats,
+                     workers=EPG_PARSE_WORKERS, progress=None, aliases=None, profile=None):
+    """Loads all epg sources into channel_map in files order, stats['programmes'] counts loaded programmes.
+
+    Results of not changed sources are taken from parsed cache, others are parsed in the current process or with
+    workers > 1 in process pool: first all at once, then again sources which depend on channels from previous sources.
+    Per source stats dicts (stage, state, file, cached, channels, programmes, time) are appended to progress list.
+    aliases are (aliases, hash) applied to all sources, aliases file is read when it is None.
+    With FilterProfile every source is parsed in the current process without parsed cache, in its own profile section.
+    """
+    if aliases is None:
+        aliases = get_aliases(logger)
+    aliases, aliases_hash = aliases
+    start_time = time.time()
+    keys = {}
+    results = {}
+    source_stats = {}
+    for epg_file in files:
+        source_stats[epg_file] = {'stage': 'parse', 'state': 'queued', 'file': epg_file, 'cached': False,
+                                  'channels': 0, 'programmes': 0, 'time': 0.0}
+        if progress is not None:
+            progress.append(source_stats[epg_file])
+    for epg_file in files:
+        keys[epg_file] = get_parsed_cache_key(epg_file, m3u_hash, aliases_hash, today, today_plus_one_week)
+        results[epg_file] = load_parsed_cache(logger, epg_file, keys[epg_file]) if EPG_PARSED_CACHE and profile is None \
+            else None
+
+    if workers > 1 and profile is None:
+        previous_ids = set()
+        known_ids_map = {}
+        for epg_file in files:
+            if results[epg_file] is None:
+                known_ids_map[epg_file] = previous_ids.copy()
+            else:
+                previous_ids |= results[epg_file]['matched_ids']
+        for epg_file in known_ids_map:
+            source_stats[epg_file]['state'] = 'running'
+        results.update(parse_epg_sources_in_pool(logger, today, today_plus_one_week, m3u_hash, known_ids_map, workers,
+                                                         aliases))
+
+        previous_ids = set()
+        known_ids_map = {}
+        for epg_file in files:
+            result = results[epg_file]
+            if result is not None:
+                if not is_parsed_result_valid(result, previous_ids):
+                    known_ids_map[epg_file] = previous_ids & result['foreign_ids']
+                previous_ids |= result['matched_ids']
+        results.update(parse_epg_sources_in_pool(logger, today, today_plus_one_week, m3u_hash, known_ids_map, workers,
+                                                         aliases))
+
+    previous_ids = set()
+    for epg_file in files:
+        source = source_stats[epg_file]
+        source['state'] = 'running'
+        try:
+            result = results[epg_file]
+            if not is_parsed_result_valid(result, previous_ids):
+                with profile.section(get_source_name(epg_file)) if profile is not None else nullcontext():
+                    result = parse_epg_source(logger, today, today_plus_one_week, m3u_index, epg_file, previous_ids,
+                                              aliases)
+            if result.get('cached'):
+                logger.info('load_epg_sources(%s), not changed, taken from parsed cache' % epg_file)
+            elif EPG_PARSED_CACHE:
+                store_parsed_cache(epg_file, keys[epg_file], result)
+            programmes = stats['programmes']
+            replay_start_time = time.time()
+            replay_xmlt_events(m3u_index, result['events'], channel_map, stats)
+            previous_ids |= result['matched_ids']
+            # Time spent on the source in this run: parsing unless it was cached and replaying
+            source.update(state='done', cached=result.get('cached', False), channels=len(result['matched_ids']),
+                          programmes=stats['programmes'] - programmes,
+                          time=(0.0 if result.get('cached') else result['time']) + time.time() - replay_start_time)
+            observe_parse(epg_file, result)
+        except Exception as e:
+            logger.error('load_epg_sources(%s), unexpected exception: %s' % (epg_file, repr(e)))
+            traceback.print_exc()
+            source['state'] = 'failed'
+    metrics.stage_seconds.observe(time.time() - start_time, 'parse')
+
+
+def observe_parse(epg_file, result):
+    """Adds parse_epg_source() result to metrics, counts of cached result are the ones of its parsing"""
+    source = get_source_name(epg_file)
+    if result.get('cached'):
+        metrics.parse_cached.inc(source)
+    else:
+        metrics.parse_seconds.observe(result['time'], source)
+    parse_stats = result.get('stats', {})
+    metrics.source_channels.set(parse_stats.get('channels', 0), source, 'seen')
+    metrics.source_channels.set(len(result['matched_ids']), source, 'matched')
+    metrics.source_programmes.set(parse_stats.get('programmes', 0), source, 'kept')
+    metrics.source_programmes.set(parse_stats.get('out_of_window', 0), source, 'out_of_window')
+    metrics.source_programmes.set(parse_stats.get('unknown_channel', 0), source, 'unknown_channel')
+    metrics.source_programmes.set(parse_stats.get('rescued', 0), source, 'rescued')
+    metrics.source_programmes.set(parse_stats.get('spilled', 0), source, 'spilled')
+
+
 def gzip_file(source_file, gz_file):
-    with open(source_file, 'rb') as f_in:
-        with gzip.open(gz_file, 'wb') as f_out:
+    tmp_file_name = gz_file + '.tmp'
+    with open(source_file, 'rb') as f_in, open(tmp_file_name, 'wb') as f_tmp:
+        with gzip.GzipFile(gz_file, 'wb', fileobj=f_tmp) as f_out:
             shutil.copyfileobj(f_in, f_out)
+    os.replace(tmp_file_name, gz_file)
+
+
+class GzipTeeFile:
+    """Text file written in one pass together with its gzip copy (name + '.gz'), writes are buffered"""
+    def __init__(self, file_name, buffer_size=WRITE_BUFFER_SIZE, compress_level=GZIP_COMPRESS_LEVEL):
+        self.name = file_name
+        self.gz_name = file_name + '.gz'
+        self.buffer = []
+        self.buffer_length = 0
+        self.buffer_size = buffer_size
+        self.file = open(file_name, 'wb')
+        self.gz_file = gzip.GzipFile(self.gz_name, 'wb', compresslevel=compress_level)
+
+    def write(self, string):
+        self.buffer.append(string)
+        self.buffer_length += len(string)
+        if self.buffer_length >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            data = ''.join(self.buffer).encode('utf-8')
+            self.file.write(data)
+            self.gz_file.write(data)
+            self.buffer = []
+            self.buffer_length = 0
+
+    def close(self):
+        self.flush()
+        self.gz_file.close()
+        self.file.close()
 
 
 def num_sort(test_string):
     return list(map(int, re.findall(r'\d+', test_string)))[0]
 
 
-def get_new_m3u_file(logger):
-    logger.info("get_new_m3u_file()")
+def get_new_snapshot_folder(logger):
+    folder = SNAPSHOTS_FOLDER + str(time.time_ns()) + '/'
+    logger.info("get_new_snapshot_folder(), folder: %s" % folder)
+    os.makedirs(folder)
+    return folder
+
+
+def publish_snapshot(logger, folder):
+    """Switches 'current' link to the snapshot folder in one rename, readers get either old or new files"""
+    logger.info("publish_snapshot(%s)" % folder)
+    tmp_link = CURRENT_SNAPSHOT_LINK + '.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.relpath(folder, CACHE_FOLDER), tmp_link)
+    os.replace(tmp_link, CURRENT_SNAPSHOT_LINK)
+    remove_old_snapshots(logger)
+
+
+def remove_old_snapshots(logger, keep=SNAPSHOTS_KEEP):
+    current = os.path.realpath(CURRENT_SNAPSHOT_LINK)
+    snapshots = sorted(glob.glob(SNAPSHOTS_FOLDER + '*'))
+    for folder in snapshots[:-max(keep, 1)]:
+        if os.path.realpath(folder) != current:
+            logger.info("remove_old_snapshots(), remove: %s" % folder)
+            shutil.rmtree(folder, ignore_errors=True)
+
 
-    if os.path.exists(M3U_UPDATED_CACHE_FILE_PATH):
-        logger.info("get_new_m3u_file() remove existing file, %s" % M3U_UPDATED_CACHE_FILE_PATH)
-        os.remove(M3U_UPDATED_CACHE_FILE_PATH)
-    if os.path.exists(M3U_UPDATED_GZ_CACHE_FILE_PATH):
-        logger.info("get_new_m3u_file() remove existing file, %s" % M3U_UPDATED_GZ_CACHE_FILE_PATH)
-        os.remove(M3U_UPDATED_GZ_CACHE_FILE_PATH)
+def get_new_m3u_file(logger, folder):
+    logger.info("get_new_m3u_file(%s)" % folder)
 
-    f = open(M3U_UPDATED_CACHE_FILE_PATH, 'w')
+    f = GzipTeeFile(folder + M3U_UPDATED_FILE)
     f.write("#EXTM3U\n")
     return f
 
 
-def get_epg_file(logger, request_host):
-    logger.info('get_epg_file()')
+def get_epg_header(request_host):
+    return "<?xml version='1.0' encoding='UTF-8'?>\n" \
+           "<!DOCTYPE tv SYSTEM \"http://{url}/xmltv.dtd\">\n" \
+           "<tv generator-info-name=\"iptv-helper\" generator-info-url=\"https://github.com/Redwid/iptv-helper\">\n".format(url=request_host)
 
-    if os.path.exists(EPG_ALL_CACHE_FILE_PATH):
-        logger.info("get_epg_file(), remove existing file: %s" % EPG_ALL_CACHE_FILE_PATH)
-        os.remove(EPG_ALL_CACHE_FILE_PATH)
-    if os.path.exists(EPG_ALL_GZ_CACHE_FILE_PATH):
-        logger.info("get_epg_file(), remove existing file: %s" % EPG_ALL_GZ_CACHE_FILE_PATH)
-        os.remove(EPG_ALL_GZ_CACHE_FILE_PATH)
 
-    f = open(EPG_ALL_CACHE_FILE_PATH, 'w')
-    f.write("<?xml version='1.0' encoding='UTF-8'?>\n")
-    f.write("<!DOCTYPE tv SYSTEM \"http://{url}/xmltv.dtd\">\n".format(url=request_host))
-    f.write("<tv generator-info-name=\"iptv-helper\" generator-info-url=\"https://github.com/Redwid/iptv-helper\">\n")
+def get_epg_file(logger, request_host, folder):
+    logger.info('get_epg_file(%s)' % folder)
+
+    f = GzipTeeFile(folder + EPG_ALL_FILE)
+    f.write(get_epg_header(request_host))
 
     return f
 
@@ -378,104 +956,191 @@ def get_epg_file(logger, request_host):
 def finish_file(logger, f):
     logger.info("finish_file(), file: %s" % f.name)
 
-    f.flush()
     f.close()
 
     file_size = os.path.getsize(f.name)
     logger.info("finish_file(%s) done, file size: %s (%s)" % (f.name, file_size, sizeof_fmt(file_size)))
 
-    f_gz = f.name + ".gz"
-    gzip_file(f.name, f_gz)
-
-    file_size = os.path.getsize(f_gz)
-    logger.info("finish_file(%s) done, file size: %s (%s)" % (f_gz, file_size, sizeof_fmt(file_size)))
+    gz_file_size = os.path.getsize(f.gz_name)
+    logger.info("finish_file(%s) done, file size: %s (%s), ratio: %.1f" % (f.gz_name, gz_file_size, sizeof_fmt(gz_file_size),
+                                                                         file_size / max(gz_file_size, 1)))
+    name = os.path.basename(f.name)
+    metrics.output_bytes.set(file_size, name)
+    metrics.output_bytes.set(gz_file_size, name + '.gz')
+    metrics.output_compression_ratio.set(file_size / max(gz_file_size, 1), name)
 
 
-def write_m3u_and_epg(logger, m3u_list, request_host):
+def write_m3u_and_epg(logger, m3u_list, request_host, progress=None):
     logger.info("write_m3u_and_epg(), list: %d" % len(m3u_list))
+    start_time = time.time()
+    stats = {'stage': 'write', 'state': 'running', 'channels': 0, 'programmes': 0, 'time': 0.0}
+    if progress is not None:
+        progress.append(stats)
 
-    m3u_file = get_new_m3u_file(logger)
-    logger.info('write_m3u_and_epg() prepare m3u_entries list')
-
-    channels = []
-    programs = []
-    try:
-        for m3u_item in m3u_list:
-            m3u_file.write(m3u_item.to_m3u_string())
-            m3u_item.add_channels_and_programs(channels, programs)
-        logger.info('write_m3u_and_epg() m3u_item size: %d' % len(m3u_list))
-    except Exception as e:
-        logger.error('ERROR in write_m3u_and_epg()', exc_info=True)
-        traceback.print_exc()
-    finish_file(logger, m3u_file)
+    # Merged before anything is written, so m3u rows of the store get programme counts of merged channels
+    if EPG_MERGE:
+        merge_channels(logger, m3u_list, EPG_FILL_GAPS, {'programmes': 0, 'duplicates': 0, 'overlaps': 0, 'cuts': 0,
+                                                          'filled': 0})
 
-    epg_file = get_epg_file(logger, request_host)
-    logger.info('write_m3u_and_epg() prepare channels')
-    try:
-        for channel_item in channels:
-            epg_file.write(channel_item.to_xml_string())
-        logger.info('write_m3u_and_epg() channels done: %d' % len(channels))
-    except Exception as e:
-        logger.error('ERROR in prepare channels in write_m3u_and_epg()', exc_info=True)
-        traceback.print_exc()
+    snapshot_folder = get_new_snapshot_folder(logger)
+    m3u_file = get_new_m3u_file(logger, snapshot_folder)
+    store = EpgStoreWriter(logger, snapshot_folder + EPG_STORE_FILE) if EPG_STORE else None
 
-    logger.info('write_epg_xml() prepare programmes')
-    dates = {'start.oldest': None, 'start.newest': None, 'stop.oldest': None, 'stop.newest': None}
+    # Snapshot is published only when all of it was written, readers keep the last good one otherwise
+    failed = []
     try:
-        for programme_item in programs:
-            string = programme_item.to_xml_string(dates)
-            if string is not None:
+        logger.info('write_m3u_and_epg() prepare m3u_entries list')
+        channels = []
+        try:
+            for position, m3u_item in enumerate(m3u_list):
+                string = m3u_item.to_m3u_string()
+                m3u_file.write(string)
+                m3u_item.add_channels(channels)
+                if store is not None:
+                    store.add_m3u_item(position, m3u_item, string)
+            logger.info('write_m3u_and_epg() m3u_item size: %d' % len(m3u_list))
+        except Exception as e:
+            logger.error('ERROR in write_m3u_and_epg()', exc_info=True)
+            traceback.print_exc()
+            failed.append('m3u')
+        finish_file(logger, m3u_file)
+
+        epg_file = get_epg_file(logger, request_host, snapshot_folder)
+        logger.info('write_m3u_and_epg() prepare channels')
+        # Channel matched by several m3u items is written to epg for each of them, but stored once
+        stored_ids = set()
+        try:
+            for channel_item in channels:
+                string = channel_item.to_xml_string()
                 epg_file.write(string)
-        logger.info('write_m3u_and_epg() programs size: %d' % len(programs))
-        logger.info('write_m3u_and_epg() start.oldest: %s, start.newest: %s' % (str(dates['start.oldest']), str(dates['start.newest'])))
-        logger.info('write_m3u_and_epg() start.oldest.str: %s, start.newest.str: %s' % (str(dates['start.oldest.str']), str(dates['start.newest.str'])))
-        logger.info('write_m3u_and_epg() stop.oldest: %s, stop.newest: %s' % (str(dates['stop.oldest']), str(dates['stop.newest'])))
-        logger.info('write_m3u_and_epg() stop.oldest.str: %s, stop.newest.str: %s' % (str(dates['stop.oldest.str']), str(dates['stop.newest.str'])))
-    except Exception as e:
-        logger.error('ERROR in prepare programme in write_m3u_and_epg()', exc_info=True)
-        traceback.print_exc()
-
-    epg_file.write("</tv>\n")
-    finish_file(logger, epg_file)
-
-
-def filter_epg(logger, request_host):
-    logger.info("filter_epg(), request_host: %s" % request_host)
+                if store is not None and channel_item.id not in stored_ids:
+                    store.add_channel(channel_item, string)
+                    stored_ids.add(channel_item.id)
+            logger.info('write_m3u_and_epg() channels done: %d' % len(channels))
+        except Exception as e:
+            logger.error('ERROR in prepare channels in write_m3u_and_epg()', exc_info=True)
+            traceback.print_exc()
+            failed.append('channels')
+
+        logger.info('write_epg_xml() prepare programmes')
+        dates = {'start.oldest': None, 'start.newest': None, 'stop.oldest': None, 'stop.newest': None}
+        stored_ids = set()
+        written = 0
+        try:
+            for channel_item in channels:
+                is_stored = store is not None and channel_item.id not in stored_ids
+                stored_ids.add(channel_item.id)
+                for programme_item in channel_item.programs:
+                    string = programme_item.to_xml_string(dates)
+                    if string is not None:
+                        epg_file.write(string)
+                        written += 1
+                        if is_stored:
+                            store.add_programme(programme_item, string)
+            logger.info('write_m3u_and_epg() programs written: %d' % written)
+            logger.info('write_m3u_and_epg() start.oldest: %s, start.newest: %s' % (
+                str(dates.get('start.oldest')), str(dates.get('start.newest'))))
+            logger.info('write_m3u_and_epg() start.oldest.str: %s, start.newest.str: %s' % (
+                str(dates.get('start.oldest.str')), str(dates.get('start.newest.str'))))
+            logger.info('write_m3u_and_epg() stop.oldest: %s, stop.newest: %s' % (
+                str(dates.get('stop.oldest')), str(dates.get('stop.newest'))))
+            logger.info('write_m3u_and_epg() stop.oldest.str: %s, stop.newest.str: %s' % (
+                str(dates.get('stop.oldest.str')), str(dates.get('stop.newest.str'))))
+        except Exception as e:
+            logger.error('ERROR in prepare programme in write_m3u_and_epg()', exc_info=True)
+            traceback.print_exc()
+            failed.append('programmes')
+
+        epg_file.write("</tv>\n")
+        finish_file(logger, epg_file)
+        if len(failed) > 0:
+            raise Exception("write_m3u_and_epg(), failed: %s" % ', '.join(failed))
+        if store is not None:
+            store.close({'request_host': request_host, 'start.oldest': dates.get('start.oldest.str'),
+                         'start.newest': dates.get('start.newest.str'), 'stop.oldest': dates.get('stop.oldest.str'),
+                         'stop.newest': dates.get('stop.newest.str')})
+    except Exception:
+        if store is not None:
+            store.abort()
+        logger.error("write_m3u_and_epg(), snapshot is not published: %s" % snapshot_folder)
+        shutil.rmtree(snapshot_folder, ignore_errors=True)
+        raise
+    publish_snapshot(logger, snapshot_folder)
+    stats.update(state='done', channels=len(channels), programmes=written, time=time.time() - start_time)
+    metrics.stage_seconds.observe(stats['time'], 'write')
+
+
+def get_coverage(m3u_list):
+    """Returns coverage of m3u list by loaded epg from programme counts kept by channels: m3u, matched (with epg
+    channels), with_programmes, programmes of selected channels and not_present list of m3u items without programmes:
+    position, name, group_title, tvg_id, channels (matched epg channel ids)"""
+    matched = 0
+    programmes = 0
+    not_present = []
+    for position, m3u_item in enumerate(m3u_list):
+        if len(m3u_item.channels) > 0:
+            matched += 1
+            programmes += m3u_item.get_max_programs().get_programs_count()
+        if m3u_item.get_programs_count() == 0:
+            not_present.append({'position': position, 'name': m3u_item.name, 'group_title': m3u_item.group_title,
+                                'tvg_id': m3u_item.tvg_id, 'channels': list(m3u_item.channels)})
+    return {'m3u': len(m3u_list), 'matched': matched, 'with_programmes': len(m3u_list) - len(not_present),
+            'programmes': programmes, 'not_present': not_present}
+
+
+def filter_epg(logger, request_host, workers=EPG_PARSE_WORKERS, progress=None, profile=EPG_PROFILE):
+    """Builds combined epg and updated m3u from downloaded files.
+
+    With profile cpu profile and allocations of m3u parsing, every epg source and writing are saved into
+    PROFILES_FOLDER, profile stats dict (stage, state, id) is appended to progress list.
+    """
+    logger.info("filter_epg(), request_host: %s, workers: %d, profile: %s" % (request_host, workers, profile))
     start_time = time.time()
-    m3u_list = parse_m3u(logger, M3U_CACHE_FILE_PATH)
-
-    channel_map = {}
-    programme_list = []
-    downloaded = glob.glob(CACHE_FOLDER + 'epg-*.xml')
-    if EPG_ALL_CACHE_FILE_PATH in downloaded:
-        downloaded.remove(EPG_ALL_CACHE_FILE_PATH)
-    downloaded = sorted(downloaded, key=num_sort)
-    # downloaded = [CACHE_FOLDER + 'epg-1.xml']
-
-    # processed_m3u_entries = m3u_list.copy()
-    today = date.today()
-    today_plus_one_week = today + timedelta(days=7)
-    logger.info('filter_epg(), today: %s, today_plus_one_week: %s' % (today, today_plus_one_week))
-    for file in downloaded:
-        if EPG_ALL_FILE not in file:
-            try:
-                load_xmlt(logger, today, today_plus_one_week, m3u_list, file, channel_map, programme_list)
-            except Exception as e:
-                logger.error('filter_epg(), unexpected exception: %s' % repr(e))
-                traceback.print_exc()
-
-    logger.info('filter_epg(), m3u_list: %d channel_map size: %d, programme_list: %d, time: %sms ' % (
-    len(m3u_list), len(channel_map), len(programme_list), time.time() - start_time))
-    channel_map.clear()
-    programme_list.clear()
-
-    logger.info("filter_epg(), Not preset:")
-    index = 0
-    for value in m3u_list:
-        if value.get_programs_count() == 0:
-            logger.info("   %d. %s" % (index, value))
-            index += 1
-    logger.info("filter_epg(), Not preset count: %d" % index)
-
-    write_m3u_and_epg(logger, m3u_list, request_host)
+    filter_profile = None
+    if profile:
+        filter_profile = FilterProfile(logger, PROFILES_FOLDER + str(time.time_ns()) + '/', PROFILE_TOP)
+        profile_stats = {'stage': 'profile', 'state': 'running', 'id': filter_profile.id}
+        if progress is not None:
+            progress.append(profile_stats)
+    try:
+        with filter_profile.section('m3u') if filter_profile is not None else nullcontext():
+            m3u_list = parse_m3u(logger, M3U_CACHE_FILE_PATH)
+            m3u_index = M3uIndex(m3u_list)
+            m3u_hash = get_file_hash(M3U_CACHE_FILE_PATH)
+
+        channel_map = {}
+        stats = {'programmes': 0}
+        downloaded = get_epg_source_files()
+        # downloaded = [CACHE_FOLDER + 'epg-1.xml']
+
+        # processed_m3u_entries = m3u_list.copy()
+        today = date.today()
+        today_plus_one_week = today + timedelta(days=EPG_WINDOW_DAYS)
+        logger.info('filter_epg(), today: %s, today_plus_one_week: %s, window: %d days' % (today, today_plus_one_week, EPG_WINDOW_DAYS))
+        load_epg_sources(logger, today, today_plus_one_week, m3u_index, m3u_hash, downloaded, channel_map, stats, workers,
+                         progress, profile=filter_profile)
+
+        logger.info('filter_epg(), m3u_list: %d channel_map size: %d, programmes: %d, time: %ss ' % (
+        len(m3u_list), len(channel_map), stats['programmes'], time.time() - start_time))
+        logger.info('filter_epg(), %s' % m3u_index)
+        channel_map.clear()
+
+        coverage = get_coverage(m3u_list)
+        logger.info('filter_epg(), coverage: %s' % json.dumps(coverage, ensure_ascii=False))
+        if progress is not None:
+            progress.append(dict(coverage, stage='coverage', state='done'))
+        metrics.m3u_channels.set(coverage['m3u'], 'all')
+        metrics.m3u_channels.set(coverage['with_programmes'], 'with_programmes')
+
+        with filter_profile.section('write') if filter_profile is not None else nullcontext():
+            write_m3u_and_epg(logger, m3u_list, request_host, progress)
+        if filter_profile is not None:
+            profile_stats['state'] = 'done'
+    finally:
+        if filter_profile is not None:
+            if profile_stats['state'] != 'done':
+                profile_stats['state'] = 'failed'
+            filter_profile.close()
+            remove_old_profiles(logger, PROFILES_FOLDER, PROFILES_KEEP)
     logger.info("filter_epg(), done in: %s" % (time.time() - start_time))
+    metrics.stage_seconds.observe(time.time() - start_time, 'filter')